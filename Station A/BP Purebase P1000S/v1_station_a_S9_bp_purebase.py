@@ -1,7 +1,12 @@
 from opentrons import protocol_api
+from opentrons.types import Point
 import json
 import os
 import math
+import sys
+from functools import wraps
+from time import time
+from types import MethodType
 
 # metadata
 metadata = {
@@ -14,13 +19,489 @@ metadata = {
 NUM_SAMPLES = 96
 SAMPLE_VOLUME = 400
 TIP_TRACK = False
+PROFILE = False
+PREDISPENSE_LYSIS = False
+RETURN_TIPS = False  # drop used tips back in their rack instead of the trash
+MIX_PROFILE = {}  # e.g. {'dispense_rate': 2, 'spots': 4, 'turnovers': 2.4}
+
+# how each liquid is pipetted, see LiquidClass
+LIQUID_CLASSES = {
+    'sample': {'aspirate': 250, 'dispense': 500, 'blow_out': 500,
+               'air_gap': 100},
+    'lysis': {'aspirate': 250, 'dispense': 500, 'blow_out': 500,
+              'air_gap': 100},
+    'internal control': {'air_gap': 5}
+}
+
+# gantry speeds (mm/s) without and with liquid in the tip, see GantrySpeeds
+GANTRY_SPEEDS = {'empty': 600, 'loaded': 400}
+TRIP_MARGIN = 20  # µl of tip capacity left unused on every stroke, see TripPlanner
+
+
+# Definitions for run profiling
+class RunProfiler:
+    """
+    `RunProfiler` records the wall-clock start and end of each wrapped
+    pipette, module and protocol context call, tagged with the phase of the
+    protocol it was made from. The phase is the innermost protocol function
+    that is not a helper, or `phase` for calls made directly from `run`.
+    """
+    PIPETTE_CALLS = ['transfer', 'distribute', 'mix', 'aspirate', 'dispense',
+                     'air_gap', 'blow_out', 'touch_tip', 'move_to',
+                     'pick_up_tip', 'drop_tip']
+    HELPERS = ['pick_up', 'drop', 'h_track', 'mix', 'wait']
+
+    def __init__(self, protocol_file):
+        self.protocol_file = protocol_file
+        self.phase = 'setup'
+        self.calls = []
+        self._stack = []
+        self._paused = False
+
+    def wrap(self, obj, names):
+        for name in names:
+            if hasattr(obj, name):
+                setattr(obj, name, MethodType(
+                    self._timed(getattr(obj, name).__func__, name), obj))
+
+    def _current_phase(self):
+        frame = sys._getframe(2)
+        while frame:
+            name = frame.f_code.co_name
+            if frame.f_code.co_filename == self.protocol_file:
+                if name == 'run':
+                    break
+                if name not in self.HELPERS and \
+                        not name.startswith(('_', '<')):
+                    return name
+            frame = frame.f_back
+        return self.phase
+
+    def _timed(self, method, name):
+        @wraps(method)
+        def _timed_call(*args, **kwargs):
+            call = {'call': name, 'phase': self._current_phase(),
+                    'depth': len(self._stack), 'start': time(), 'nested': 0}
+            self._stack.append(call)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._stack.pop()
+                call['end'] = time()
+                duration = call['end'] - call['start']
+                call['self'] = duration - call.pop('nested')
+                if self._stack:
+                    self._stack[-1]['nested'] += duration
+                # the first robot move after a pause blocks until the
+                # operator resumes, so its time is spent waiting
+                call['operator'] = name == 'pause' or (
+                    self._paused and call['self'] == duration)
+                if call['operator'] and name != 'pause':
+                    self._paused = False
+                elif name == 'pause':
+                    self._paused = True
+                self.calls.append(call)
+        return _timed_call
+
+    def report(self):
+        phases = {}
+        call_types = {}
+        for call in self.calls:
+            phase = phases.setdefault(
+                call['phase'], {'robot': 0, 'operator': 0})
+            phase['operator' if call['operator'] else 'robot'] += call['self']
+            call_type = call_types.setdefault(
+                call['call'], {'count': 0, 'seconds': 0})
+            call_type['count'] += 1
+            call_type['seconds'] += call['self']
+        log = sorted(self.calls, key=lambda call: call['start'])
+        return {
+            'robot': sum(phase['robot'] for phase in phases.values()),
+            'operator': sum(phase['operator'] for phase in phases.values()),
+            'wall': log[-1]['end'] - log[0]['start'] if log else 0,
+            'phases': phases,
+            'calls': call_types,
+            'log': log
+        }
+
+
+# Definitions for module commands
+class ModuleCommand:
+    """
+    `ModuleCommand` is the handle of a module command that was started
+    without waiting for it to finish, so that the protocol can keep
+    pipetting and only wait where the result is needed. Waiting on a command
+    that has already been waited on returns immediately.
+    """
+
+    def __init__(self, wait):
+        self._wait = wait
+
+    @classmethod
+    def temperature(cls, tempdeck, celsius):
+        """
+        `temperature` starts ramping a temperature module to `celsius` and
+        returns the handle to await the target temperature with.
+        """
+        tempdeck.start_set_temperature(celsius)
+        return cls(lambda: tempdeck.await_temperature(celsius))
+
+    def wait(self):
+        if self._wait:
+            self._wait()
+            self._wait = None
+
+
+# Definitions for tip tracking
+class TipAllocator:
+    """
+    `TipAllocator` hands out tips from the tipracks of every pipette and
+    keeps an occupancy bitmap per rack, with racks identified by their deck
+    slot and bit i set once tip i (in `rack.wells()` order) is used.
+    Multichannel pipettes get full fresh columns from any rack, including
+    racks a single-channel pipette has broken. Single-channel pipettes take
+    tips from partly used columns and racks first, so that full columns stay
+    available to the multichannel.
+    When saving, every pick-up is appended to the ledger file as it happens,
+    so a crash, E-stop or cancelled run loses no tip state and the next run
+    starts at the next fresh tip. Every `COMPACT_EVERY` entries the file is
+    atomically replaced by a single snapshot entry.
+    """
+    COMPACT_EVERY = 100
+    FULL_COLUMN = 0xff
+
+    def __init__(self, path, save):
+        self.path = path
+        self.save = save
+        self.used = {}
+        self.entries = 0
+        if save and os.path.isfile(path):
+            with open(path) as ledger_file:
+                for line in ledger_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn by an interrupted write, drop it from the file
+                        self._compact()
+                        break
+                    self._apply(entry)
+                    self.entries += 1
+
+    def _apply(self, entry):
+        if 'snapshot' in entry:
+            self.used = {}
+            for slot, tips in entry['snapshot'].items():
+                self._mark(slot, tips)
+        elif 'reset' in entry:
+            for slot in entry['reset']:
+                self.used.pop(slot, None)
+        else:
+            self._mark(entry['slot'], entry['tips'])
+
+    def _mark(self, slot, tips):
+        for tip in tips:
+            self.used[slot] = self.used.get(slot, 0) | 1 << tip
+
+    def _write(self, path, mode, entry):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        with open(path, mode) as ledger_file:
+            ledger_file.write(json.dumps(entry) + '\n')
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+
+    def _compact(self):
+        self._write(self.path + '.tmp', 'w', {'snapshot': self.snapshot()})
+        os.replace(self.path + '.tmp', self.path)
+        self.entries = 1
+
+    def _record(self, entry):
+        self._apply(entry)
+        if not self.save:
+            return
+        if self.entries >= self.COMPACT_EVERY:
+            self._compact()
+        else:
+            self._write(self.path, 'a', entry)
+            self.entries += 1
+
+    def next_tip(self, racks, channels=1):
+        """
+        `next_tip` returns the well to pick up tips from, or None if `racks`
+        hold no full column (multichannel) or no tip (single-channel).
+        :param racks (List[Labware]): The pipette's tipracks, in order.
+        :param channels (int): The number of channels of the pipette.
+        """
+        best = None
+        for order, rack in enumerate(racks):
+            used = self.used.get(rack.parent, 0)
+            for col in range(12):
+                col_used = used >> col*8 & self.FULL_COLUMN
+                if channels > 1:
+                    if col_used:
+                        continue
+                    key = (used == 0, order, col)
+                    index = col*8
+                else:
+                    if col_used == self.FULL_COLUMN:
+                        continue
+                    row = next(r for r in range(8) if not col_used >> r & 1)
+                    key = (col_used == 0, used == 0, order, col)
+                    index = col*8 + row
+                if best is None or key < best[0]:
+                    best = (key, rack, index)
+        return best[1].wells()[best[2]] if best else None
+
+    def remaining(self, racks, channels=1):
+        """
+        `remaining` returns the number of pick-ups left in `racks` before
+        they need replacing.
+        """
+        count = 0
+        for rack in racks:
+            used = self.used.get(rack.parent, 0)
+            if channels > 1:
+                count += sum(1 for col in range(12)
+                             if not used >> col*8 & self.FULL_COLUMN)
+            else:
+                count += 96 - bin(used).count('1')
+        return count
+
+    def use(self, tip, channels=1):
+        index = tip.parent.wells().index(tip)
+        self._record({'slot': tip.parent.parent,
+                      'tips': list(range(index, index + channels))})
+
+    def reset(self, racks):
+        self._record({'reset': [rack.parent for rack in racks]})
+
+    def snapshot(self):
+        return {slot: [i for i in range(96) if used >> i & 1]
+                for slot, used in self.used.items()}
+
+    def restore(self, snapshot):
+        """
+        `restore` marks the tips used in a saved `snapshot` as used, keeping
+        the tips used since it was taken.
+        """
+        for slot, tips in snapshot.items():
+            self._record({'slot': slot, 'tips': tips})
+
+
+# Definitions for mixing
+class Mixer:
+    """
+    `Mixer` mixes wells with the mixing profile of a protocol, so that
+    resuspension can be validated with fewer, more effective cycles. The
+    profile may set:
+    - `aspirate_rate` and `dispense_rate`: multiples of the pipette's flow
+      rates, a fast dispense jet resuspends beads in fewer cycles
+    - `spots`: the number of dispense spots `radius` mm around the well
+      centre that consecutive cycles dispense at, and `heights`: the heights
+      above the mixing location the spots are repeated at
+    - `turnovers`: how many times the liquid in the well is cycled through
+      the tip, which sets the repetitions from the volume in the well. The
+      repetitions a protocol asks for are the maximum, `min_reps` the
+      minimum.
+    Without a profile, `mix` is the pipette's own mix.
+    """
+
+    def __init__(self, profile=None):
+        profile = profile or {}
+        self.aspirate_rate = profile.get('aspirate_rate', 1.0)
+        self.dispense_rate = profile.get('dispense_rate', 1.0)
+        self.spots = profile.get('spots', 1)
+        self.radius = profile.get('radius', 2)
+        self.heights = profile.get('heights', [0])
+        self.turnovers = profile.get('turnovers')
+        self.min_reps = profile.get('min_reps', 3)
+
+    def reps(self, reps, vol, liquid=None):
+        """
+        `reps` returns the repetitions to mix `vol` in a well holding
+        `liquid` µl with, at most `reps`.
+        """
+        if not self.turnovers or not liquid:
+            return reps
+        return min(max(math.ceil(self.turnovers*liquid/vol), self.min_reps),
+                   reps)
+
+    def _spot(self, well, loc, cycle):
+        height = self.heights[cycle//self.spots % len(self.heights)]
+        if self.spots == 1:
+            return loc.move(Point(z=height))
+        angle = 2*math.pi*(cycle % self.spots)/self.spots
+        return well.bottom(loc.point.z - well.bottom().point.z + height).move(
+            Point(x=self.radius*math.cos(angle),
+                  y=self.radius*math.sin(angle)))
+
+    def mix(self, pip, reps, vol, well, loc=None, liquid=None):
+        """
+        `mix` mixes `vol` in `well` up to `reps` times.
+        :param pip (InstrumentContext): The pipette to mix with.
+        :param reps (int): The repetitions to mix with without a profile.
+        :param vol (float): The volume of each mixing cycle.
+        :param well (Well): The well to mix.
+        :param loc (Location): Where in `well` to aspirate from, by default
+                               the pipette's aspirate clearance above its
+                               bottom.
+        :param liquid (float): The volume in the well, for the profile's
+                               `turnovers`.
+        """
+        reps = self.reps(reps, vol, liquid)
+        if self.aspirate_rate == self.dispense_rate == 1 and \
+                self.spots == 1 and self.heights == [0]:
+            pip.mix(reps, vol, well if loc is None else loc)
+            return
+        if loc is None:
+            loc = well.bottom(pip.well_bottom_clearance.aspirate)
+        for cycle in range(reps):
+            pip.aspirate(vol, loc, rate=self.aspirate_rate)
+            pip.dispense(vol, self._spot(well, loc, cycle),
+                         rate=self.dispense_rate)
+
+
+# Definitions for liquid classes
+class LiquidClass:
+    """
+    `LiquidClass` is how a liquid is pipetted: its aspirate, dispense and
+    blow-out flow rates (µl/s, the pipette's own when not set), how many
+    seconds to wait after aspirating it for a viscous liquid to finish
+    entering the tip, the air gap (µl) it is carried with and the gantry
+    speed (mm/s) it is carried at, see `GantrySpeeds`. Settings that differ
+    for a pipette model are overridden under the model's name in `pipettes`.
+    The wait only follows aspirations the protocol makes itself, not those
+    of `transfer`.
+    """
+    RATES = ['aspirate', 'dispense', 'blow_out']
+
+    def __init__(self, aspirate=None, dispense=None, blow_out=None, delay=0,
+                 air_gap=0, speed=None, pipettes=None):
+        self.aspirate = aspirate
+        self.dispense = dispense
+        self.blow_out = blow_out
+        self.delay = delay
+        self.air_gap = air_gap
+        self.speed = speed
+        self.pipettes = pipettes or {}
+
+    def use(self, pip):
+        """
+        `use` sets the flow rates of `pip` for the liquid and returns the
+        liquid class with the settings for the pipette's model.
+        """
+        settings = dict(vars(self), pipettes=None)
+        settings.update(self.pipettes.get(pip.name, {}))
+        liquid = LiquidClass(**settings)
+        for action in self.RATES:
+            if getattr(liquid, action):
+                setattr(pip.flow_rate, action, getattr(liquid, action))
+        return liquid
+
+    def wait(self, ctx):
+        if self.delay:
+            ctx.delay(seconds=self.delay)
+
+
+# Definitions for gantry speeds
+class GantrySpeeds:
+    """
+    `GantrySpeeds` sets the gantry speed (mm/s) of every move of a wrapped
+    pipette from what its tip holds: `empty` without a tip or with an empty
+    tip, `loaded` with liquid in the tip, or the `speed` of the liquid class
+    the pipette carries, if it has one. An air gap alone does not load the
+    tip. The speed is set after each tip and plunger call, for the moves of
+    the next one.
+    """
+    CALLS = ['pick_up_tip', 'drop_tip', 'aspirate', 'dispense', 'blow_out']
+
+    def __init__(self, speeds):
+        self.empty = speeds.get('empty', 400)
+        self.loaded = speeds.get('loaded', 400)
+        self._carrying = {}
+
+    def wrap(self, pip):
+        for name in self.CALLS:
+            setattr(pip, name, MethodType(
+                self._setting_speed(getattr(pip, name).__func__), pip))
+        pip.air_gap = MethodType(
+            self._keeping_speed(pip.air_gap.__func__), pip)
+        pip.default_speed = self.empty
+
+    def _setting_speed(self, method):
+        @wraps(method)
+        def _set_speed(pip, *args, **kwargs):
+            result = method(pip, *args, **kwargs)
+            if pip.hw_pipette['has_tip'] and pip.current_volume > 0:
+                pip.default_speed = self._carrying.get(pip) or self.loaded
+            else:
+                pip.default_speed = self.empty
+            return result
+        return _set_speed
+
+    def _keeping_speed(self, method):
+        @wraps(method)
+        def _keep_speed(pip, *args, **kwargs):
+            speed = pip.default_speed
+            result = method(pip, *args, **kwargs)
+            pip.default_speed = speed
+            return result
+        return _keep_speed
+
+    def carry(self, pip, liquid):
+        """
+        `carry` applies the liquid class `liquid` to `pip`, see
+        `LiquidClass.use`, and moves the pipette at the speed of the liquid
+        while its tip is loaded.
+        """
+        liquid = liquid.use(pip)
+        self._carrying[pip] = liquid.speed
+        return liquid
+
+
+# Definitions for trip planning
+class TripPlanner:
+    """
+    `TripPlanner` splits a transfer into the fewest strokes that fit the tip,
+    all of the same volume. A stroke holds the volume of the tips the pipette
+    is loaded with (never more than the pipette's own or the `tip_volume`
+    (µl) the tips are known to hold), less the air gaps of the liquid class
+    it is carried with and a safety `margin` (µl).
+    """
+
+    def __init__(self, margin=0, tip_volume=None):
+        self.margin = margin
+        self.tip_volume = tip_volume
+
+    def capacity(self, pip, liquid=None, air_gaps=1):
+        """
+        `capacity` returns the largest volume a stroke of `pip` can carry.
+        :param pip (InstrumentContext): The pipette.
+        :param liquid (LiquidClass): The liquid class the stroke is carried
+                                     with, if any.
+        :param air_gaps (int): How many air gaps of the liquid the tip holds
+                               next to the stroke.
+        """
+        tip_vol = min([pip.max_volume] + [
+            rack.wells()[0].max_volume for rack in pip.tip_racks] + (
+            [self.tip_volume] if self.tip_volume else []))
+        air_gap = liquid.air_gap if liquid else 0
+        return tip_vol - air_gaps*air_gap - self.margin
+
+    def strokes(self, pip, vol, liquid=None, air_gaps=1):
+        """
+        `strokes` returns the volume of each stroke of a transfer of `vol`.
+        """
+        capacity = self.capacity(pip, liquid, air_gaps)
+        num_strokes = max(math.ceil(round(vol/capacity, 6)), 1)
+        return [vol/num_strokes]*num_strokes
 
 
 def run(ctx: protocol_api.ProtocolContext):
 
     # load labware
     tempdeck = ctx.load_module('Temperature Module Gen2', '10')
-    tempdeck.set_temperature(4)
     internal_control = tempdeck.load_labware(
         'opentrons_96_aluminumblock_generic_pcr_strip_200ul',
         'chilled tubeblock for internal control (strip 1)').wells()[0]
@@ -45,52 +526,58 @@ def run(ctx: protocol_api.ProtocolContext):
     m20 = ctx.load_instrument('p20_multi_gen2', 'left', tip_racks=tipracks20)
     p1000 = ctx.load_instrument(
         'p1000_single_gen2', 'right', tip_racks=tipracks1000)
-    p1000.flow_rate.aspirate = 250
-    p1000.flow_rate.dispense = 500
-    p1000.flow_rate.blow_out = 500
+    liquids = {name: LiquidClass(**settings)
+               for name, settings in LIQUID_CLASSES.items()}
+    planner = TripPlanner(TRIP_MARGIN)
+
+    speeds = GantrySpeeds(GANTRY_SPEEDS)
+    for pip in [m20, p1000]:
+        speeds.wrap(pip)
+
+    profiler = RunProfiler(run.__code__.co_filename)
+    if PROFILE:
+        profiler.wrap(ctx, ['delay', 'pause', 'home'])
+        profiler.wrap(tempdeck, ['set_temperature', 'await_temperature'])
+        for pip in [m20, p1000]:
+            profiler.wrap(pip, RunProfiler.PIPETTE_CALLS)
+
+    cooling = ModuleCommand.temperature(tempdeck, 4)
 
     # setup samples
     sources = [
         well for rack in source_racks for well in rack.wells()][:NUM_SAMPLES]
     dests_single = dest_plate.wells()[:NUM_SAMPLES]
-    dests_multi = dest_plate.rows()[0][:math.ceil(NUM_SAMPLES)]
+    dests_multi = dest_plate.rows()[0][:math.ceil(NUM_SAMPLES/8)]
 
-    tip_log = {'count': {}}
     folder_path = '/data/A'
-    tip_file_path = folder_path + '/tip_log.json'
-    if TIP_TRACK and not ctx.is_simulating():
-        if os.path.isfile(tip_file_path):
-            with open(tip_file_path) as json_file:
-                data = json.load(json_file)
-                if 'tips1000' in data:
-                    tip_log['count'][p1000] = data['tips1000']
-                else:
-                    tip_log['count'][p1000] = 0
-                if 'tips20' in data:
-                    tip_log['count'][m20] = data['tips20']
-                else:
-                    tip_log['count'][m20] = 0
-    else:
-        tip_log['count'] = {p1000: 0, m20: 0}
-
-    tip_log['tips'] = {
-        p1000: [tip for rack in tipracks1000 for tip in rack.wells()],
-        m20: [tip for rack in tipracks20 for tip in rack.rows()[0]]
-    }
-    tip_log['max'] = {
-        pip: len(tip_log['tips'][pip])
-        for pip in [p1000, m20]
-    }
+    allocator = TipAllocator(folder_path + '/tip_ledger.jsonl',
+                             TIP_TRACK and not ctx.is_simulating())
+
+    picked = {}  # the rack well each pipette's tip was picked up from
 
     def pick_up(pip):
-        nonlocal tip_log
-        if tip_log['count'][pip] == tip_log['max'][pip]:
+        tip = allocator.next_tip(pip.tip_racks, pip.channels)
+        if tip is None:
             ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
 resuming.')
             pip.reset_tipracks()
-            tip_log['count'][pip] = 0
-        pip.pick_up_tip(tip_log['tips'][pip][tip_log['count'][pip]])
-        tip_log['count'][pip] += 1
+            allocator.reset(pip.tip_racks)
+            tip = allocator.next_tip(pip.tip_racks, pip.channels)
+        pip.pick_up_tip(tip)
+        allocator.use(tip, pip.channels)
+        picked[pip] = tip
+
+    def drop(pip):
+        if RETURN_TIPS:
+            # the allocator keeps the well used, so the tip is never reused
+            pip.drop_tip(picked[pip])
+        else:
+            pip.drop_tip()
+
+    for pip in [m20, p1000]:
+        ctx.comment(str(allocator.remaining(pip.tip_racks, pip.channels)) +
+                    ' tip pick-ups left for ' + pip.name + ' before its \
+tipracks need replacing.')
 
     heights = {lys_buff: 20}
     radius = (lys_buff.diameter)/2
@@ -105,43 +592,74 @@ resuming.')
             heights[tube] = 5
         return tube.bottom(heights[tube])
 
+    mixer = Mixer(MIX_PROFILE)
+
+    # pre-distribute lysis buffer + proteinase K to empty wells with one tip
+    if PREDISPENSE_LYSIS:
+        profiler.phase = 'lysis buffer'
+        lysis = speeds.carry(p1000, liquids['lysis'])
+        pick_up(p1000)
+        wells_per_asp = max(int(planner.capacity(p1000, lysis)//210), 1)
+        for i in range(0, len(dests_single), wells_per_asp):
+            dests = dests_single[i:i+wells_per_asp]
+            p1000.aspirate(210*len(dests), h_track(lys_buff, 210*len(dests)))
+            lysis.wait(ctx)
+            p1000.air_gap(lysis.air_gap)
+            for j, d in enumerate(dests):
+                # the air gap leaves the tip with the first dispense
+                p1000.dispense(
+                    210 + lysis.air_gap if j == 0 else 210, d.top())
+            p1000.blow_out(dests[-1].top())
+        drop(p1000)
+
     # transfer sample
+    profiler.phase = 'sample transfer'
+    sample = speeds.carry(p1000, liquids['sample'])
+    sample_strokes = planner.strokes(p1000, SAMPLE_VOLUME, sample)
     for s, d in zip(sources, dests_single):
         pick_up(p1000)
-        p1000.transfer(SAMPLE_VOLUME, s.bottom(5), d.bottom(5), air_gap=100,
-                       new_tip='never')
-        p1000.air_gap(100)
-        p1000.drop_tip()
+        for stroke_vol in sample_strokes:
+            p1000.transfer(stroke_vol, s.bottom(5), d.bottom(5),
+                           air_gap=sample.air_gap, new_tip='never')
+        if PREDISPENSE_LYSIS:
+            mixer.mix(p1000, 10, 100, d, d.bottom(5), SAMPLE_VOLUME + 210)
+        p1000.air_gap(sample.air_gap)
+        drop(p1000)
 
     # transfer lysis buffer + proteinase K and mix
-    for s, d in zip(sources, dests_single):
-        pick_up(p1000)
-        p1000.transfer(210, h_track(lys_buff, 210), d.bottom(5), air_gap=100,
-                       mix_after=(10, 100), new_tip='never')
-        p1000.air_gap(100)
-        p1000.drop_tip()
+    if not PREDISPENSE_LYSIS:
+        profiler.phase = 'lysis buffer'
+        lysis = speeds.carry(p1000, liquids['lysis'])
+        for s, d in zip(sources, dests_single):
+            pick_up(p1000)
+            for stroke_vol in planner.strokes(p1000, 210, lysis):
+                p1000.transfer(stroke_vol, h_track(lys_buff, stroke_vol),
+                               d.bottom(5), air_gap=lysis.air_gap,
+                               new_tip='never')
+            mixer.mix(p1000, 10, 100, d, d.bottom(5), SAMPLE_VOLUME + 210)
+            p1000.air_gap(lysis.air_gap)
+            drop(p1000)
 
-    ctx.pause('Incubate sample plate (slot 4) at 55-57˚C for 20 minutes. \
-Return to slot 4 when complete.')
+    ctx.pause('Incubate sample plate (slot 1) at 55-57˚C for 20 minutes. \
+Return to slot 1 when complete.')
 
     # transfer internal control
+    profiler.phase = 'internal control'
+    cooling.wait()
+    control = speeds.carry(m20, liquids['internal control'])
     for d in dests_multi:
         pick_up(m20)
-        m20.transfer(10, internal_control, d.bottom(10), air_gap=5,
-                     new_tip='never')
-        m20.air_gap(5)
-        m20.drop_tip()
+        m20.transfer(10, internal_control, d.bottom(10),
+                     air_gap=control.air_gap, new_tip='never')
+        m20.air_gap(control.air_gap)
+        drop(m20)
 
-    ctx.comment('Move deepwell plate (slot 4) to Station B for RNA \
+    ctx.comment('Move deepwell plate (slot 1) to Station B for RNA \
 extraction.')
 
-    # track final used tip
-    if not ctx.is_simulating():
+    # write run profile
+    if PROFILE and not ctx.is_simulating():
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
-        data = {
-            'tips1000': tip_log['count'][p1000],
-            'tips20': tip_log['count'][m20]
-        }
-        with open(tip_file_path, 'w') as outfile:
-            json.dump(data, outfile)
+        with open(folder_path + '/run_profile.json', 'w') as outfile:
+            json.dump(profiler.report(), outfile)
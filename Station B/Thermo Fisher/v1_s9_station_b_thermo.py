@@ -2,8 +2,11 @@ from opentrons.types import Point
 import json
 import os
 import math
+import sys
 import threading
-from time import sleep
+from functools import wraps
+from time import sleep, time
+from types import MethodType
 
 metadata = {
     'protocolName': 'V1 S9 Thermo Fisher COVID-19 Station B RNA Extraction',
@@ -26,6 +29,30 @@ settling_time = 2
 park_tips = True
 tip_track = False
 flash = True
+profile = False
+track_supernatant = False
+predispense_reagents = False
+checkpoint = False
+resume = True
+waste2_slot = None  # e.g. '10', replaces the tiprack in that slot
+interleave = False
+mix_profile = {}  # e.g. {'dispense_rate': 2, 'turnovers': 2.4}
+bead_remix_after = 120  # s after which a binding bead well is mixed again
+# how each liquid is pipetted, see LiquidClass
+liquid_classes = {
+    'beads': {'aspirate': 50, 'dispense': 150, 'blow_out': 300,
+              'air_gap': 20},
+    'supernatant': {'aspirate': 30, 'dispense': 150, 'blow_out': 300,
+                    'air_gap': 20},
+    'wash': {'aspirate': 150, 'dispense': 150, 'blow_out': 300,
+             'air_gap': 20},
+    'elution': {'aspirate': 150, 'dispense': 150, 'blow_out': 300,
+                'air_gap': 20}
+}
+# gantry speeds (mm/s) without and with liquid in the tip
+gantry_speeds = {'empty': 600, 'loaded': 400}
+trip_margin = 0  # µl of tip capacity left unused on each stroke, the filter tips are rated below the filter
+tip_volume = 200  # µl the filter tips hold, their racks are loaded as opentrons_96_tiprack_300ul
 MAG_HEIGHT = 13.7
 
 # Definitions for deck light flashing
@@ -55,6 +82,554 @@ def create_thread(ctx, cancel_token):
     return t1
 
 
+# Definitions for run profiling
+class RunProfiler:
+    """
+    `RunProfiler` records the wall-clock start and end of each wrapped
+    pipette, module and protocol context call, tagged with the phase of the
+    protocol it was made from. The phase is the innermost protocol function
+    that is not a helper, or `phase` for calls made directly from `run`.
+    """
+    PIPETTE_CALLS = ['transfer', 'distribute', 'mix', 'aspirate', 'dispense',
+                     'air_gap', 'blow_out', 'touch_tip', 'move_to',
+                     'pick_up_tip', 'drop_tip']
+    HELPERS = ['pick_up', 'drop', 'h_track', 'mix', 'wait']
+
+    def __init__(self, protocol_file):
+        self.protocol_file = protocol_file
+        self.phase = 'setup'
+        self.calls = []
+        self._stack = []
+        self._paused = False
+
+    def wrap(self, obj, names):
+        for name in names:
+            if hasattr(obj, name):
+                setattr(obj, name, MethodType(
+                    self._timed(getattr(obj, name).__func__, name), obj))
+
+    def _current_phase(self):
+        frame = sys._getframe(2)
+        while frame:
+            name = frame.f_code.co_name
+            if frame.f_code.co_filename == self.protocol_file:
+                if name == 'run':
+                    break
+                if name not in self.HELPERS and \
+                        not name.startswith(('_', '<')):
+                    return name
+            frame = frame.f_back
+        return self.phase
+
+    def _timed(self, method, name):
+        @wraps(method)
+        def _timed_call(*args, **kwargs):
+            call = {'call': name, 'phase': self._current_phase(),
+                    'depth': len(self._stack), 'start': time(), 'nested': 0}
+            self._stack.append(call)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._stack.pop()
+                call['end'] = time()
+                duration = call['end'] - call['start']
+                call['self'] = duration - call.pop('nested')
+                if self._stack:
+                    self._stack[-1]['nested'] += duration
+                # the first robot move after a pause blocks until the
+                # operator resumes, so its time is spent waiting
+                call['operator'] = name == 'pause' or (
+                    self._paused and call['self'] == duration)
+                if call['operator'] and name != 'pause':
+                    self._paused = False
+                elif name == 'pause':
+                    self._paused = True
+                self.calls.append(call)
+        return _timed_call
+
+    def report(self):
+        phases = {}
+        call_types = {}
+        for call in self.calls:
+            phase = phases.setdefault(
+                call['phase'], {'robot': 0, 'operator': 0})
+            phase['operator' if call['operator'] else 'robot'] += call['self']
+            call_type = call_types.setdefault(
+                call['call'], {'count': 0, 'seconds': 0})
+            call_type['count'] += 1
+            call_type['seconds'] += call['self']
+        log = sorted(self.calls, key=lambda call: call['start'])
+        return {
+            'robot': sum(phase['robot'] for phase in phases.values()),
+            'operator': sum(phase['operator'] for phase in phases.values()),
+            'wall': log[-1]['end'] - log[0]['start'] if log else 0,
+            'phases': phases,
+            'calls': call_types,
+            'log': log
+        }
+
+
+# Definitions for module commands
+class ModuleCommand:
+    """
+    `ModuleCommand` is the handle of a module command that was started
+    without waiting for it to finish, so that the protocol can keep
+    pipetting and only wait where the result is needed. Waiting on a command
+    that has already been waited on returns immediately.
+    """
+
+    def __init__(self, wait):
+        self._wait = wait
+
+    @classmethod
+    def temperature(cls, tempdeck, celsius):
+        """
+        `temperature` starts ramping a temperature module to `celsius` and
+        returns the handle to await the target temperature with.
+        """
+        tempdeck.start_set_temperature(celsius)
+        return cls(lambda: tempdeck.await_temperature(celsius))
+
+    @classmethod
+    def settle(cls, ctx, minutes, msg):
+        """
+        `settle` starts timing a settling step, such as beads pelleting on
+        the magnet, and returns the handle to wait for the rest of it with.
+        Only the time that is left when it is waited on is delayed for.
+        """
+        end = time() + minutes*60
+
+        def _wait():
+            if end > time():
+                ctx.delay(seconds=end - time(), msg=msg)
+        return cls(_wait)
+
+    def wait(self):
+        if self._wait:
+            self._wait()
+            self._wait = None
+
+
+# Definitions for tip tracking
+class TipAllocator:
+    """
+    `TipAllocator` hands out tips from the tipracks of every pipette and
+    keeps an occupancy bitmap per rack, with racks identified by their deck
+    slot and bit i set once tip i (in `rack.wells()` order) is used.
+    Multichannel pipettes get full fresh columns from any rack, including
+    racks a single-channel pipette has broken. Single-channel pipettes take
+    tips from partly used columns and racks first, so that full columns stay
+    available to the multichannel.
+    When saving, every pick-up is appended to the ledger file as it happens,
+    so a crash, E-stop or cancelled run loses no tip state and the next run
+    starts at the next fresh tip. Every `COMPACT_EVERY` entries the file is
+    atomically replaced by a single snapshot entry.
+    """
+    COMPACT_EVERY = 100
+    FULL_COLUMN = 0xff
+
+    def __init__(self, path, save):
+        self.path = path
+        self.save = save
+        self.used = {}
+        self.entries = 0
+        if save and os.path.isfile(path):
+            with open(path) as ledger_file:
+                for line in ledger_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn by an interrupted write, drop it from the file
+                        self._compact()
+                        break
+                    self._apply(entry)
+                    self.entries += 1
+
+    def _apply(self, entry):
+        if 'snapshot' in entry:
+            self.used = {}
+            for slot, tips in entry['snapshot'].items():
+                self._mark(slot, tips)
+        elif 'reset' in entry:
+            for slot in entry['reset']:
+                self.used.pop(slot, None)
+        else:
+            self._mark(entry['slot'], entry['tips'])
+
+    def _mark(self, slot, tips):
+        for tip in tips:
+            self.used[slot] = self.used.get(slot, 0) | 1 << tip
+
+    def _write(self, path, mode, entry):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        with open(path, mode) as ledger_file:
+            ledger_file.write(json.dumps(entry) + '\n')
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+
+    def _compact(self):
+        self._write(self.path + '.tmp', 'w', {'snapshot': self.snapshot()})
+        os.replace(self.path + '.tmp', self.path)
+        self.entries = 1
+
+    def _record(self, entry):
+        self._apply(entry)
+        if not self.save:
+            return
+        if self.entries >= self.COMPACT_EVERY:
+            self._compact()
+        else:
+            self._write(self.path, 'a', entry)
+            self.entries += 1
+
+    def next_tip(self, racks, channels=1):
+        """
+        `next_tip` returns the well to pick up tips from, or None if `racks`
+        hold no full column (multichannel) or no tip (single-channel).
+        :param racks (List[Labware]): The pipette's tipracks, in order.
+        :param channels (int): The number of channels of the pipette.
+        """
+        best = None
+        for order, rack in enumerate(racks):
+            used = self.used.get(rack.parent, 0)
+            for col in range(12):
+                col_used = used >> col*8 & self.FULL_COLUMN
+                if channels > 1:
+                    if col_used:
+                        continue
+                    key = (used == 0, order, col)
+                    index = col*8
+                else:
+                    if col_used == self.FULL_COLUMN:
+                        continue
+                    row = next(r for r in range(8) if not col_used >> r & 1)
+                    key = (col_used == 0, used == 0, order, col)
+                    index = col*8 + row
+                if best is None or key < best[0]:
+                    best = (key, rack, index)
+        return best[1].wells()[best[2]] if best else None
+
+    def remaining(self, racks, channels=1):
+        """
+        `remaining` returns the number of pick-ups left in `racks` before
+        they need replacing.
+        """
+        count = 0
+        for rack in racks:
+            used = self.used.get(rack.parent, 0)
+            if channels > 1:
+                count += sum(1 for col in range(12)
+                             if not used >> col*8 & self.FULL_COLUMN)
+            else:
+                count += 96 - bin(used).count('1')
+        return count
+
+    def use(self, tip, channels=1):
+        index = tip.parent.wells().index(tip)
+        self._record({'slot': tip.parent.parent,
+                      'tips': list(range(index, index + channels))})
+
+    def reset(self, racks):
+        self._record({'reset': [rack.parent for rack in racks]})
+
+    def snapshot(self):
+        return {slot: [i for i in range(96) if used >> i & 1]
+                for slot, used in self.used.items()}
+
+    def restore(self, snapshot):
+        """
+        `restore` marks the tips used in a saved `snapshot` as used, keeping
+        the tips used since it was taken.
+        """
+        for slot, tips in snapshot.items():
+            self._record({'slot': slot, 'tips': tips})
+
+
+# Definitions for mixing
+class Mixer:
+    """
+    `Mixer` mixes wells with the mixing profile of a protocol, so that
+    resuspension can be validated with fewer, more effective cycles. The
+    profile may set:
+    - `aspirate_rate` and `dispense_rate`: multiples of the pipette's flow
+      rates, a fast dispense jet resuspends beads in fewer cycles
+    - `spots`: the number of dispense spots `radius` mm around the well
+      centre that consecutive cycles dispense at, and `heights`: the heights
+      above the mixing location the spots are repeated at
+    - `turnovers`: how many times the liquid in the well is cycled through
+      the tip, which sets the repetitions from the volume in the well. The
+      repetitions a protocol asks for are the maximum, `min_reps` the
+      minimum.
+    Without a profile, `mix` is the pipette's own mix.
+    """
+
+    def __init__(self, profile=None):
+        profile = profile or {}
+        self.aspirate_rate = profile.get('aspirate_rate', 1.0)
+        self.dispense_rate = profile.get('dispense_rate', 1.0)
+        self.spots = profile.get('spots', 1)
+        self.radius = profile.get('radius', 2)
+        self.heights = profile.get('heights', [0])
+        self.turnovers = profile.get('turnovers')
+        self.min_reps = profile.get('min_reps', 3)
+
+    def reps(self, reps, vol, liquid=None):
+        """
+        `reps` returns the repetitions to mix `vol` in a well holding
+        `liquid` µl with, at most `reps`.
+        """
+        if not self.turnovers or not liquid:
+            return reps
+        return min(max(math.ceil(self.turnovers*liquid/vol), self.min_reps),
+                   reps)
+
+    def _spot(self, well, loc, cycle):
+        height = self.heights[cycle//self.spots % len(self.heights)]
+        if self.spots == 1:
+            return loc.move(Point(z=height))
+        angle = 2*math.pi*(cycle % self.spots)/self.spots
+        return well.bottom(loc.point.z - well.bottom().point.z + height).move(
+            Point(x=self.radius*math.cos(angle),
+                  y=self.radius*math.sin(angle)))
+
+    def mix(self, pip, reps, vol, well, loc=None, liquid=None):
+        """
+        `mix` mixes `vol` in `well` up to `reps` times.
+        :param pip (InstrumentContext): The pipette to mix with.
+        :param reps (int): The repetitions to mix with without a profile.
+        :param vol (float): The volume of each mixing cycle.
+        :param well (Well): The well to mix.
+        :param loc (Location): Where in `well` to aspirate from, by default
+                               the pipette's aspirate clearance above its
+                               bottom.
+        :param liquid (float): The volume in the well, for the profile's
+                               `turnovers`.
+        """
+        reps = self.reps(reps, vol, liquid)
+        if self.aspirate_rate == self.dispense_rate == 1 and \
+                self.spots == 1 and self.heights == [0]:
+            pip.mix(reps, vol, well if loc is None else loc)
+            return
+        if loc is None:
+            loc = well.bottom(pip.well_bottom_clearance.aspirate)
+        for cycle in range(reps):
+            pip.aspirate(vol, loc, rate=self.aspirate_rate)
+            pip.dispense(vol, self._spot(well, loc, cycle),
+                         rate=self.dispense_rate)
+
+
+# Definitions for liquid classes
+class LiquidClass:
+    """
+    `LiquidClass` is how a liquid is pipetted: its aspirate, dispense and
+    blow-out flow rates (µl/s, the pipette's own when not set), how many
+    seconds to wait after aspirating it for a viscous liquid to finish
+    entering the tip, the air gap (µl) it is carried with and the gantry
+    speed (mm/s) it is carried at, see `GantrySpeeds`. Settings that differ
+    for a pipette model are overridden under the model's name in `pipettes`.
+    The wait only follows aspirations the protocol makes itself, not those
+    of `transfer`.
+    """
+    RATES = ['aspirate', 'dispense', 'blow_out']
+
+    def __init__(self, aspirate=None, dispense=None, blow_out=None, delay=0,
+                 air_gap=0, speed=None, pipettes=None):
+        self.aspirate = aspirate
+        self.dispense = dispense
+        self.blow_out = blow_out
+        self.delay = delay
+        self.air_gap = air_gap
+        self.speed = speed
+        self.pipettes = pipettes or {}
+
+    def use(self, pip):
+        """
+        `use` sets the flow rates of `pip` for the liquid and returns the
+        liquid class with the settings for the pipette's model.
+        """
+        settings = dict(vars(self), pipettes=None)
+        settings.update(self.pipettes.get(pip.name, {}))
+        liquid = LiquidClass(**settings)
+        for action in self.RATES:
+            if getattr(liquid, action):
+                setattr(pip.flow_rate, action, getattr(liquid, action))
+        return liquid
+
+    def wait(self, ctx):
+        if self.delay:
+            ctx.delay(seconds=self.delay)
+
+
+# Definitions for gantry speeds
+class GantrySpeeds:
+    """
+    `GantrySpeeds` sets the gantry speed (mm/s) of every move of a wrapped
+    pipette from what its tip holds: `empty` without a tip or with an empty
+    tip, `loaded` with liquid in the tip, or the `speed` of the liquid class
+    the pipette carries, if it has one. An air gap alone does not load the
+    tip. The speed is set after each tip and plunger call, for the moves of
+    the next one.
+    """
+    CALLS = ['pick_up_tip', 'drop_tip', 'aspirate', 'dispense', 'blow_out']
+
+    def __init__(self, speeds):
+        self.empty = speeds.get('empty', 400)
+        self.loaded = speeds.get('loaded', 400)
+        self._carrying = {}
+
+    def wrap(self, pip):
+        for name in self.CALLS:
+            setattr(pip, name, MethodType(
+                self._setting_speed(getattr(pip, name).__func__), pip))
+        pip.air_gap = MethodType(
+            self._keeping_speed(pip.air_gap.__func__), pip)
+        pip.default_speed = self.empty
+
+    def _setting_speed(self, method):
+        @wraps(method)
+        def _set_speed(pip, *args, **kwargs):
+            result = method(pip, *args, **kwargs)
+            if pip.hw_pipette['has_tip'] and pip.current_volume > 0:
+                pip.default_speed = self._carrying.get(pip) or self.loaded
+            else:
+                pip.default_speed = self.empty
+            return result
+        return _set_speed
+
+    def _keeping_speed(self, method):
+        @wraps(method)
+        def _keep_speed(pip, *args, **kwargs):
+            speed = pip.default_speed
+            result = method(pip, *args, **kwargs)
+            pip.default_speed = speed
+            return result
+        return _keep_speed
+
+    def carry(self, pip, liquid):
+        """
+        `carry` applies the liquid class `liquid` to `pip`, see
+        `LiquidClass.use`, and moves the pipette at the speed of the liquid
+        while its tip is loaded.
+        """
+        liquid = liquid.use(pip)
+        self._carrying[pip] = liquid.speed
+        return liquid
+
+
+# Definitions for trip planning
+class TripPlanner:
+    """
+    `TripPlanner` splits a transfer into the fewest strokes that fit the tip,
+    all of the same volume. A stroke holds the volume of the tips the pipette
+    is loaded with (never more than the pipette's own or the `tip_volume`
+    (µl) the tips are known to hold), less the air gaps of the liquid class
+    it is carried with and a safety `margin` (µl).
+    """
+
+    def __init__(self, margin=0, tip_volume=None):
+        self.margin = margin
+        self.tip_volume = tip_volume
+
+    def capacity(self, pip, liquid=None, air_gaps=1):
+        """
+        `capacity` returns the largest volume a stroke of `pip` can carry.
+        :param pip (InstrumentContext): The pipette.
+        :param liquid (LiquidClass): The liquid class the stroke is carried
+                                     with, if any.
+        :param air_gaps (int): How many air gaps of the liquid the tip holds
+                               next to the stroke.
+        """
+        tip_vol = min([pip.max_volume] + [
+            rack.wells()[0].max_volume for rack in pip.tip_racks] + (
+            [self.tip_volume] if self.tip_volume else []))
+        air_gap = liquid.air_gap if liquid else 0
+        return tip_vol - air_gaps*air_gap - self.margin
+
+    def strokes(self, pip, vol, liquid=None, air_gaps=1):
+        """
+        `strokes` returns the volume of each stroke of a transfer of `vol`.
+        """
+        capacity = self.capacity(pip, liquid, air_gaps)
+        num_strokes = max(math.ceil(round(vol/capacity, 6)), 1)
+        return [vol/num_strokes]*num_strokes
+
+
+# Definitions for reagent reservoirs
+class ReservoirLedger:
+    """
+    `ReservoirLedger` keeps track of the reagent left in each reservoir well.
+    A reagent is filled into as few of its wells as hold what the run needs,
+    each to at most `FILL` of its volume and with a dead volume `DEAD_HEIGHT`
+    mm deep on top of its share. Reagent is drawn from the well nearest the
+    destination that still holds enough, `IMMERSION` mm below the surface
+    the stroke leaves and never lower than `MIN_HEIGHT` mm above the bottom.
+    """
+    FILL = 0.9
+    DEAD_HEIGHT = 2
+    IMMERSION = 2
+    MIN_HEIGHT = 0.5
+
+    def __init__(self):
+        self.wells = []
+        self.volumes = []
+
+    @staticmethod
+    def _area(well):
+        return well.max_volume/(well.top().point.z - well.bottom().point.z)
+
+    def load(self, ctx, name, wells, vol):
+        """
+        `load` adds the wells of a reagent and comments how to fill them.
+        :param name (str): The reagent, for the comment.
+        :param wells (List[Well]): The wells of the reagent, in the order
+                                   they are filled.
+        :param vol (float): The volume the run draws from them.
+        """
+        dead_vol = self.DEAD_HEIGHT*self._area(wells[0])
+        num_wells = min(max(math.ceil(
+            vol/(wells[0].max_volume*self.FILL - dead_vol)), 1), len(wells))
+        fill = math.ceil((vol/num_wells + dead_vol)/100)*100
+        for i, well in enumerate(wells):
+            self.wells.append(well)
+            self.volumes.append(fill if i < num_wells else 0)
+        filled, labware = wells[0].display_name.split(' of ', 1)
+        if num_wells > 1:
+            filled += ' to ' + wells[num_wells-1].display_name.split(' of ')[0]
+        ctx.comment('Fill ' + filled + ' of ' + labware + ' with ' +
+                    str(fill/1000) + ' ml of ' + name +
+                    (' each.' if num_wells > 1 else '.'))
+
+    def draw(self, wells, vol, dest):
+        """
+        `draw` takes `vol` from the well of `wells` nearest `dest` that holds
+        enough, or from the fullest if none does, and returns the well and
+        where to aspirate from.
+        """
+        def _left(well):
+            return self.volumes[self.wells.index(well)] - vol
+
+        def _travel(well):
+            top, target = well.top().point, dest.top().point
+            return math.hypot(top.x - target.x, top.y - target.y)
+
+        room = [well for well in wells
+                if _left(well) >= self.DEAD_HEIGHT*self._area(well)]
+        well = min(room, key=_travel) if room else max(wells, key=_left)
+        i = self.wells.index(well)
+        self.volumes[i] -= vol
+        height = max(self.volumes[i]/self._area(well) - self.IMMERSION,
+                     self.MIN_HEIGHT)
+        return well, well.bottom(height)
+
+    def snapshot(self):
+        return list(self.volumes)
+
+    def restore(self, volumes):
+        self.volumes[:] = volumes
+
+
 # Start protocol
 def run(ctx):
     # Setup for flashing lights notification to empty trash
@@ -81,8 +656,10 @@ def run(ctx):
     elutionplate = tempdeck.load_labware(
                 'opentrons_96_aluminumblock_nest_wellplate_100ul',
                 'elution plate')
-    waste = ctx.load_labware('nest_1_reservoir_195ml', '11',
-                             'Liquid Waste').wells()[0].top()
+    waste_slots = [slot for slot in ['11', waste2_slot] if slot]
+    wastes = [ctx.load_labware('nest_1_reservoir_195ml', slot,
+                               'Liquid Waste').wells()[0].top()
+              for slot in waste_slots]
     res2 = ctx.load_labware(
         'nest_12_reservoir_15ml', '2', 'reagent reservoir 2')
     res1 = ctx.load_labware(
@@ -90,7 +667,7 @@ def run(ctx):
     num_cols = math.ceil(num_samples/8)
     tips300 = [ctx.load_labware('opentrons_96_tiprack_300ul', slot,
                                 '200µl filtertiprack')
-               for slot in ['3', '6', '8', '9', '10']]
+               for slot in ['3', '6', '8', '9', '10'] if slot != waste2_slot]
     if park_tips:
         parkingrack = ctx.load_labware(
             'opentrons_96_tiprack_300ul', '7', 'empty tiprack for parking')
@@ -116,53 +693,64 @@ def run(ctx):
     elution_samples_m = elutionplate.rows()[0][:num_cols]
 
     magdeck.disengage()  # just in case
-    tempdeck.set_temperature(4)
 
-    m300.flow_rate.aspirate = 50
-    m300.flow_rate.dispense = 150
-    m300.flow_rate.blow_out = 300
+    speeds = GantrySpeeds(gantry_speeds)
+    for pip in [m300]:
+        speeds.wrap(pip)
+
+    profiler = RunProfiler(run.__code__.co_filename)
+    if profile:
+        profiler.wrap(ctx, ['delay', 'pause', 'home'])
+        profiler.wrap(magdeck, ['engage', 'disengage'])
+        profiler.wrap(tempdeck, ['set_temperature', 'await_temperature'])
+        for pip in [m300]:
+            profiler.wrap(pip, RunProfiler.PIPETTE_CALLS)
+
+    cooling = ModuleCommand.temperature(tempdeck, 4)
+
+    liquids = {name: LiquidClass(**settings)
+               for name, settings in liquid_classes.items()}
+    planner = TripPlanner(trip_margin, tip_volume)
+    mixer = Mixer(mix_profile)
+    reservoirs = ReservoirLedger()
 
     folder_path = '/data/B'
-    tip_file_path = folder_path + '/tip_log.json'
-    tip_log = {'count': {}}
-    if tip_track and not ctx.is_simulating():
-        if os.path.isfile(tip_file_path):
-            with open(tip_file_path) as json_file:
-                data = json.load(json_file)
-                if 'tips300' in data:
-                    tip_log['count'][m300] = data['tips300']
-                else:
-                    tip_log['count'][m300] = 0
-        else:
-            tip_log['count'][m300] = 0
-    else:
-        tip_log['count'] = {m300: 0}
+    # a resumed run must not reuse the tips the interrupted one took, so
+    # checkpoints keep the ledger on disk as well
+    allocator = TipAllocator(folder_path + '/tip_ledger.jsonl',
+                             (tip_track or checkpoint) and not ctx.is_simulating())
 
-    tip_log['tips'] = {
-        m300: [tip for rack in tips300 for tip in rack.rows()[0]]}
-    tip_log['max'] = {m300: len(tip_log['tips'][m300])}
+    # stage of the run whose tips each parking spot holds
+    parked = [None for spot in parking_spots]
 
     def _pick_up(pip, loc=None):
-        nonlocal tip_log
-        if tip_log['count'][pip] == tip_log['max'][pip] and not loc:
+        if loc:
+            pip.pick_up_tip(loc)
+            parked[parking_spots.index(loc)] = None
+            return
+        tip = allocator.next_tip(pip.tip_racks, pip.channels)
+        if tip is None:
             ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
 resuming.')
             pip.reset_tipracks()
-            tip_log['count'][pip] = 0
-        if loc:
-            pip.pick_up_tip(loc)
-        else:
-            pip.pick_up_tip(tip_log['tips'][pip][tip_log['count'][pip]])
-            tip_log['count'][pip] += 1
+            allocator.reset(pip.tip_racks)
+            tip = allocator.next_tip(pip.tip_racks, pip.channels)
+        pip.pick_up_tip(tip)
+        allocator.use(tip, pip.channels)
 
     switch = True
     drop_count = 0
     # number of tips trash will accommodate before prompting user to empty
     drop_threshold = 120
+    ctx.comment('The trash holds about ' + str(drop_threshold) + ' tips.')
 
-    def _drop(pip):
+    def _drop(pip, loc=None):
         nonlocal switch
         nonlocal drop_count
+        if loc:
+            pip.drop_tip(loc)
+            parked[parking_spots.index(loc)] = stage_name
+            return
         side = 30 if switch else -18
         drop_loc = ctx.loaded_labwares[12].wells()[0].top().move(
             Point(x=side))
@@ -185,30 +773,197 @@ resuming.')
 
             drop_count = 0
 
-    waste_vol = 0
+    waste_vols = [0 for waste in wastes]
     waste_threshold = 185000
 
-    def remove_supernatant(vol, park=False):
+    # settling steps are only waited for once the next stage needs the plate
+    settling = ModuleCommand(None)
+
+    def _settle():
+        nonlocal settling
+        msg = 'Incubating on MagDeck for ' + str(settling_time) + ' minutes.'
+        if interleave:
+            settling = ModuleCommand.settle(ctx, settling_time, msg)
+        else:
+            ctx.delay(minutes=settling_time, msg=msg)
+
+    # supernatant tracking rate (µl/s), slow zone above pellet (mm), cross
+    # section of the 8.2x8.2mm nest_96_wellplate_2ml_deep wells (mm²) and how
+    # deep the tip stays below the modelled liquid surface (mm)
+    fast_rate = 150
+    pellet_zone = 5
+    well_area = 8.2*8.2
+    immersion = 3
+
+    def _supernatant_stroke(well, vol_left, side):
+        """
+        `_supernatant_stroke` follows the falling meniscus during supernatant
+        removal. It sets the aspirate flow rate for the next stroke and
+        returns where to aspirate from: strokes that end well above the bead
+        pellet aspirate fast from `immersion` below the liquid surface, only
+        strokes that end within `pellet_zone` of the well bottom aspirate at
+        the pellet-safe speed of the supernatant liquid class from the bottom.
+        The surface is modelled from `well_area`, `immersion` covers the
+        error of the model and of the volume left in the well.
+        :param well (Well): The deepwell the supernatant is removed from.
+        :param vol_left (float): The volume left in the well after the stroke.
+        :param side (int): The side away from the bead pellet (-1 or 1).
+        """
+        # stay submerged until the end of stroke
+        height = vol_left/well_area - immersion
+        if height > pellet_zone:
+            m300.flow_rate.aspirate = fast_rate
+        else:
+            height = 0.5
+            m300.flow_rate.aspirate = liquids['supernatant'].aspirate
+        return well.bottom(height).move(Point(x=side*2))
+
+    # when each binding bead well was last mixed
+    bead_mixes = {}
+
+    def _mix_beads(source):
+        """
+        `_mix_beads` resuspends the beads in reservoir well `source` before an
+        aspiration from it, unless they were mixed less than
+        `bead_remix_after` seconds ago, so that the beads have no time to
+        settle between the columns drawing from a well.
+        """
+        if source in bead_mixes and \
+                time() - bead_mixes[source] < bead_remix_after:
+            return
+        for _ in range(5):
+            m300.aspirate(180, source.bottom(0.5))
+            m300.dispense(180, source.bottom(5))
+        bead_mixes[source] = time()
+
+    def predispense(vol, sources, dests, liquid, mix_source=False):
+        """
+        `predispense` adds reagent to the top of all destination wells with
+        a single tip before any mixing takes place. Each aspiration fills the
+        tip and is dispensed into as many consecutive wells as it holds, so a
+        well's volume may be split across two strokes.
+        :param vol (float): The volume to add to each destination well.
+        :param sources (List[Well]): The reservoir wells of the reagent.
+        :param dests (List[Well]): The wells to dispense reagent to.
+        :param liquid (str): The liquid class of the reagent.
+        :param mix_source (boolean): Whether to mix the source wells before
+                                     aspirating (binding beads).
+        """
+        reagent = speeds.carry(m300, liquids[liquid])
+        capacity = planner.capacity(m300, reagent)
+        _pick_up(m300)
+        remaining = [vol for _ in dests]
+        i = 0
+        while i < len(dests):
+            stroke = []
+            while i < len(dests):
+                stroke_vol = min(remaining[i],
+                                 capacity - sum(v for _, v in stroke))
+                if stroke_vol <= 0:
+                    break
+                stroke.append((dests[i], stroke_vol))
+                remaining[i] -= stroke_vol
+                if remaining[i] == 0:
+                    i += 1
+            stroke_total = sum(v for _, v in stroke)
+            source, loc = reservoirs.draw(
+                sources, stroke_total*m300.channels, stroke[0][0])
+            if m300.current_volume > 0:
+                # void air gap if necessary
+                m300.dispense(m300.current_volume, source.top())
+            if mix_source:
+                _mix_beads(source)
+            m300.aspirate(stroke_total, loc)
+            reagent.wait(ctx)
+            for d, stroke_vol in stroke:
+                m300.dispense(stroke_vol, d.top())
+            m300.blow_out(stroke[-1][0].top())
+            m300.air_gap(reagent.air_gap)
+        _drop(m300)
+
+    # progress checkpoints: the last completed column of each stage is saved
+    # to /data/B so that an interrupted run can resume from there
+    checkpoint_path = folder_path + '/checkpoint.json'
+    settings = {
+        'samples': num_samples, 'park': park_tips,
+        'predispense': predispense_reagents, 'wastes': len(wastes)}
+    stage = -1
+    stage_name = None
+    saved = None
+    resume_point = None
+    if checkpoint and resume and not ctx.is_simulating() and \
+            os.path.isfile(checkpoint_path):
+        with open(checkpoint_path) as json_file:
+            saved = json.load(json_file)
+        if saved['settings'] == settings:
+            resume_point = (saved['stage'], saved['column'])
+        else:
+            ctx.comment('Ignoring the saved checkpoint, it was made with \
+different settings.')
+
+    def _next_stage(name):
+        nonlocal stage
+        nonlocal stage_name
+        stage += 1
+        stage_name = name
+
+    def _completed(column=0):
+        return resume_point is not None and (stage, column) <= resume_point
+
+    def _checkpoint(column=0):
+        if not checkpoint or ctx.is_simulating():
+            return
+        if not os.path.isdir(folder_path):
+            os.mkdir(folder_path)
+        data = {
+            'settings': settings,
+            'stage': stage,
+            'name': stage_name,
+            'column': column,
+            'magnet': magdeck.status == 'engaged',
+            'tips': allocator.snapshot(),
+            'parked': parked,
+            'drop_count': drop_count,
+            'waste_vols': waste_vols,
+            'reservoirs': reservoirs.snapshot()
+        }
+        with open(checkpoint_path + '.tmp', 'w') as outfile:
+            json.dump(data, outfile)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+    def remove_supernatant(vol, name, park=False, repark=False):
         """
         `remove_supernatant` will transfer supernatant from the deepwell
-        extraction plate to the liquid waste reservoir.
+        extraction plate to the liquid waste reservoirs.
         :param vol (float): The amount of volume to aspirate from all deepwell
                             sample wells and dispense in the liquid waste.
+        :param name (str): The step the supernatant is removed for, used to
+                           name the checkpoint stage.
         :param park (boolean): Whether to pick up sample-corresponding tips
                                in the 'parking rack' or to pick up new tips.
+        :param repark (boolean): Whether to return the tips to the 'parking
+                                 rack' for the next wash instead of dropping
+                                 them in the trash.
         """
 
-        def _waste_track(vol):
-            nonlocal waste_vol
-            if waste_vol + vol >= waste_threshold:
+        def _waste_track(vol, well):
+            """
+            `_waste_track` returns the liquid waste to dispense `vol` from
+            `well` to: the nearest one with room left, so that the run only
+            pauses to empty them once all of them are full.
+            """
+            room = [i for i, waste in enumerate(wastes)
+                    if waste_vols[i] + vol < waste_threshold]
+            if not room:
                 # Setup for flashing lights notification to empty liquid waste
                 if flash:
                     if not ctx._hw_manager.hardware.is_simulator:
                         cancellationToken.set_true()
                     thread = create_thread(ctx, cancellationToken)
                 m300.home()
-                ctx.pause('Please empty liquid waste (slot 11) before \
-resuming.')
+                ctx.pause('Please empty liquid waste (slot' +
+                          ('s ' if len(waste_slots) > 1 else ' ') +
+                          ' and '.join(waste_slots) + ') before resuming.')
 
                 ctx.home()  # home before continuing with protocol
                 if flash:
@@ -216,33 +971,50 @@ resuming.')
                     cancellationToken.set_false()
                     thread.join()
 
-                waste_vol = 0
-            waste_vol += vol
+                waste_vols[:] = [0 for waste in wastes]
+                room = list(range(len(wastes)))
+
+            def _travel(i):
+                waste, top = wastes[i].point, well.top().point
+                return math.hypot(waste.x - top.x, waste.y - top.y)
+
+            target = min(room, key=_travel)
+            waste_vols[target] += vol
+            return wastes[target]
 
-        m300.flow_rate.aspirate = 30
-        num_trans = math.ceil(vol/200)
-        vol_per_trans = vol/num_trans
+        supernatant = speeds.carry(m300, liquids['supernatant'])
+        strokes = planner.strokes(m300, vol, supernatant)
+        _next_stage(name + ' supernatant removal')
         for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
-            if park:
+            if _completed(i):
+                continue
+            if park and parked[i]:
                 _pick_up(m300, spot)
             else:
                 _pick_up(m300)
+            settling.wait()
             side = -1 if i % 2 == 0 else 1
             loc = m.bottom(0.5).move(Point(x=side*2))
-            for _ in range(num_trans):
-                _waste_track(vol_per_trans)
+            for t, vol_per_trans in enumerate(strokes):
+                if track_supernatant:
+                    loc = _supernatant_stroke(
+                        m, vol-(t+1)*vol_per_trans, side)
+                waste = _waste_track(vol_per_trans*m300.channels, m)
                 if m300.current_volume > 0:
                     # void air gap if necessary
                     m300.dispense(m300.current_volume, m.top())
                 m300.move_to(m.center())
                 m300.transfer(vol_per_trans, loc, waste, new_tip='never',
-                              air_gap=20)
+                              air_gap=supernatant.air_gap)
                 m300.blow_out(waste)
-                m300.air_gap(20)
-            _drop(m300)
-        m300.flow_rate.aspirate = 150
+                m300.air_gap(supernatant.air_gap)
+            if park and repark:
+                _drop(m300, spot)  # keep tip for the next wash
+            else:
+                _drop(m300)
+            _checkpoint(i)
 
-    def bind(vol, park=True):
+    def bind(vol, park=True, repark=False):
         """
         `bind` will perform magnetic bead binding on each sample in the
         deepwell plate. Each channel of binding beads will be mixed before
@@ -256,44 +1028,57 @@ resuming.')
                                between adding elution buffer and transferring
                                supernatant to the final clean elutions PCR
                                plate.
+        :param repark (boolean): Whether to keep the tips in the 'parking
+                                 rack' after supernatant removal.
         """
-        latest_chan = -1
+        beads = speeds.carry(m300, liquids['beads'])
+        strokes = planner.strokes(m300, vol, beads)
+        if predispense_reagents:
+            _next_stage('bind reagent')
+            if not _completed():
+                predispense(vol, binding_buffer, mag_samples_m, 'beads',
+                            mix_source=True)
+                _checkpoint()
+        _next_stage('bind')
         for i, (well, spot) in enumerate(zip(mag_samples_m, parking_spots)):
+            if _completed(i):
+                continue
             _pick_up(m300)
-            num_trans = math.ceil(vol/200)
-            vol_per_trans = vol/num_trans
-            asp_per_chan = 14000//(vol_per_trans*8)
-            for t in range(num_trans):
-                chan_ind = int((i*num_trans + t)//asp_per_chan)
-                source = binding_buffer[chan_ind]
-                if m300.current_volume > 0:
-                    # void air gap if necessary
-                    m300.dispense(m300.current_volume, source.top())
-                if chan_ind > latest_chan:  # mix if accessing new channel
-                    for _ in range(5):
-                        m300.aspirate(180, source.bottom(0.5))
-                        m300.dispense(180, source.bottom(5))
-                    latest_chan = chan_ind
-                m300.transfer(vol_per_trans, source, well.top(), air_gap=20,
-                              new_tip='never')
-                if t < num_trans - 1:
-                    m300.air_gap(20)
-            m300.mix(5, 200, well)
+            if not predispense_reagents:
+                for t, vol_per_trans in enumerate(strokes):
+                    source, loc = reservoirs.draw(
+                        binding_buffer, vol_per_trans*m300.channels, well)
+                    if m300.current_volume > 0:
+                        # void air gap if necessary
+                        m300.dispense(m300.current_volume, source.top())
+                    _mix_beads(source)
+                    m300.transfer(vol_per_trans, loc, well.top(),
+                                  air_gap=beads.air_gap, new_tip='never')
+                    if t < len(strokes) - 1:
+                        m300.air_gap(beads.air_gap)
+            mixer.mix(m300, 5, 200, well, liquid=starting_vol + vol)
             m300.blow_out(well.top(-2))
-            m300.air_gap(20)
+            m300.air_gap(beads.air_gap)
             if park:
-                m300.drop_tip(spot)
+                _drop(m300, spot)
             else:
                 _drop(m300)
+            _checkpoint(i)
 
-        magdeck.engage(height=MAG_HEIGHT)
-        ctx.delay(minutes=settling_time, msg='Incubating on MagDeck for \
-' + str(settling_time) + ' minutes.')
+        _next_stage('bind incubation')
+        if not _completed():
+            magdeck.engage(height=MAG_HEIGHT)
+            _settle()
+            if not interleave:
+                # still settling otherwise, the next stage saves the run
+                _checkpoint()
 
         # remove initial supernatant
-        remove_supernatant(vol+starting_vol, park=park)
+        remove_supernatant(vol+starting_vol, 'bind', park=park,
+                           repark=repark)
 
-    def wash(vol, source, mix_reps=15, park=True, resuspend=True):
+    def wash(vol, source, name, mix_reps=15, park=True, resuspend=True,
+             repark=False):
         """
         `wash` will perform bead washing for the extraction protocol.
         :param vol (float): The amount of volume to aspirate from each
@@ -303,6 +1088,8 @@ resuming.')
                                     > 1, `wash` automatically calculates
                                     the index of the source that should be
                                     accessed.
+        :param name (str): The name of the wash, used to name its checkpoint
+                           stages.
         :param mix_reps (int): The number of repititions to mix the beads with
                                specified wash buffer (ignored if resuspend is
                                False).
@@ -310,41 +1097,66 @@ resuming.')
                                between adding wash buffer and removing
                                supernatant.
         :param resuspend (boolean): Whether to resuspend beads in wash buffer.
+        :param repark (boolean): Whether to keep the tips in the 'parking
+                                 rack' after supernatant removal.
         """
-
-        if resuspend and magdeck.status == 'engaged':
-            magdeck.disengage()
-
-        num_trans = math.ceil(vol/200)
-        vol_per_trans = vol/num_trans
+        # the magnet only comes off for stages still to run, so a run resumed
+        # past the mixing keeps its beads pelleted
+        if predispense_reagents:
+            _next_stage(name + ' reagent')
+            if not _completed():
+                if resuspend and magdeck.status == 'engaged':
+                    magdeck.disengage()
+                predispense(vol, source, mag_samples_m, 'wash')
+                _checkpoint()
+        _next_stage(name)
+        reagent = speeds.carry(m300, liquids['wash'])
+        strokes = planner.strokes(m300, vol, reagent)
         for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
-            _pick_up(m300)
+            if predispense_reagents and not resuspend:
+                break  # reagent is added, nothing left to do per column
+            if _completed(i):
+                continue
+            if resuspend and magdeck.status == 'engaged':
+                magdeck.disengage()
+            if predispense_reagents and park and parked[i]:
+                _pick_up(m300, spot)  # resuspend with the column's own tip
+            else:
+                _pick_up(m300)
             side = 1 if i % 2 == 0 else -1
             loc = m.bottom(0.5).move(Point(x=side*2))
-            src = source[i//(12//len(source))]
-            for n in range(num_trans):
-                if m300.current_volume > 0:
-                    m300.dispense(m300.current_volume, src.top())
-                m300.transfer(vol_per_trans, src, m.top(), air_gap=20,
-                              new_tip='never')
-                if n < num_trans - 1:  # only air_gap if going back to source
-                    m300.air_gap(20)
+            if not predispense_reagents:
+                for n, vol_per_trans in enumerate(strokes):
+                    src, src_loc = reservoirs.draw(
+                        source, vol_per_trans*m300.channels, m)
+                    if m300.current_volume > 0:
+                        m300.dispense(m300.current_volume, src.top())
+                    m300.transfer(vol_per_trans, src_loc, m.top(),
+                                  air_gap=reagent.air_gap, new_tip='never')
+                    # only air_gap if going back to source
+                    if n < len(strokes) - 1:
+                        m300.air_gap(reagent.air_gap)
             if resuspend:
-                m300.mix(mix_reps, 150, loc)
+                mixer.mix(m300, mix_reps, 150, m, loc, vol)
             m300.blow_out(m.top())
-            m300.air_gap(20)
+            m300.air_gap(reagent.air_gap)
             if park:
-                m300.drop_tip(spot)
+                _drop(m300, spot)
             else:
                 _drop(m300)
+            _checkpoint(i)
 
-        if magdeck.status == 'disengaged':
-            magdeck.engage(height=MAG_HEIGHT)
+        _next_stage(name + ' incubation')
+        if not _completed():
+            if magdeck.status == 'disengaged':
+                magdeck.engage(height=MAG_HEIGHT)
 
-        ctx.delay(minutes=settling_time, msg='Incubating on MagDeck for \
-' + str(settling_time) + ' minutes.')
+            _settle()
+            if not interleave:
+                # still settling otherwise, the next stage saves the run
+                _checkpoint()
 
-        remove_supernatant(vol, park=park)
+        remove_supernatant(vol, name, park=park, repark=repark)
 
     def elute(vol, park=True):
         """
@@ -362,67 +1174,130 @@ resuming.')
         # resuspend beads in elution
         if magdeck.status == 'enagaged':
             magdeck.disengage()
+        _next_stage('elution')
+        elution = speeds.carry(m300, liquids['elution'])
         for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
+            if _completed(i):
+                continue
             _pick_up(m300)
             side = 1 if i % 2 == 0 else -1
             loc = m.bottom(0.5).move(Point(x=side*2))
-            m300.aspirate(vol, elution_solution)
+            _, src_loc = reservoirs.draw(
+                [elution_solution], vol*m300.channels, m)
+            m300.aspirate(vol, src_loc)
+            elution.wait(ctx)
             m300.move_to(m.center())
             m300.dispense(vol, loc)
-            m300.mix(mix_reps, 0.8*vol, loc)
+            mixer.mix(m300, mix_reps, 0.8*vol, m, loc, vol)
             m300.blow_out(m.bottom(5))
-            m300.air_gap(20)
+            m300.air_gap(elution.air_gap)
             if park:
-                m300.drop_tip(spot)
+                _drop(m300, spot)
             else:
                 _drop(m300)
+            _checkpoint(i)
 
         # agitate after resuspension
+        _next_stage('elution agitation')
         for i, (m, spot) in enumerate(zip(mag_samples_m, parking_spots)):
+            if _completed(i):
+                continue
             if park:
                 _pick_up(m300, spot)
             else:
                 _pick_up(m300)
             side = 1 if i % 2 == 0 else -1
             loc = m.bottom(0.5).move(Point(x=side*2))
-            m300.mix(10, 0.8*vol, loc)
+            mixer.mix(m300, 10, 0.8*vol, m, loc, vol)
             m300.blow_out(m.bottom(5))
-            m300.air_gap(20)
+            m300.air_gap(elution.air_gap)
             if park:
-                m300.drop_tip(spot)
+                _drop(m300, spot)
             else:
                 _drop(m300)
+            _checkpoint(i)
 
-        magdeck.engage(height=MAG_HEIGHT)
-        ctx.delay(minutes=settling_time, msg='Incubating on MagDeck for \
-' + str(settling_time) + ' minutes.')
+        _next_stage('elution incubation')
+        if not _completed():
+            magdeck.engage(height=MAG_HEIGHT)
+            _settle()
+            if not interleave:
+                # still settling otherwise, the next stage saves the run
+                _checkpoint()
 
+        _next_stage('elution transfer')
+        cooling.wait()
+        elution = speeds.carry(m300, liquids['elution'])
         for i, (m, e, spot) in enumerate(
                 zip(mag_samples_m, elution_samples_m, parking_spots)):
+            if _completed(i):
+                continue
             if park:
                 _pick_up(m300, spot)
             else:
                 _pick_up(m300)
+            settling.wait()
             side = -1 if i % 2 == 0 else 1
             loc = m.bottom(0.5).move(Point(x=side*2))
-            m300.transfer(vol, loc, e.bottom(5), air_gap=20, new_tip='never')
+            m300.transfer(vol, loc, e.bottom(5), air_gap=elution.air_gap,
+                          new_tip='never')
             m300.blow_out(e.top(-2))
-            m300.air_gap(20)
+            m300.air_gap(elution.air_gap)
             m300.drop_tip()
+            _checkpoint(i)
+
+    """
+    Here is where you can list the reagents that the methods called below
+    draw from the reservoirs, with the volume each sample takes.
+    """
+    reagents = [
+        # ('binding buffer', binding_buffer, binding_buffer_vol),
+        ('wash 1', wash1, wash1_vol),
+        ('wash 2', wash2, wash2_vol),
+        ('elution buffer', [elution_solution], elution_vol)
+    ]
+    for name, wells, vol in reagents:
+        reservoirs.load(ctx, name, wells, vol*m300.channels*num_cols)
+
+    # resume an interrupted run from its last completed column
+    if resume_point:
+        ctx.pause('Resuming the interrupted run after column ' +
+                  str(resume_point[1]+1) + ' of ' + saved['name'] + '. Leave \
+all plates, tipracks and the parking rack as they are. To start over instead, \
+cancel and rerun with resume = False.')
+        allocator.restore(saved['tips'])
+        drop_count = saved['drop_count']
+        waste_vols[:] = saved['waste_vols']
+        reservoirs.restore(saved['reservoirs'])
+        parked[:] = saved['parked']
+        if saved['magnet']:
+            # the beads may have come off the magnet while the run was down
+            magdeck.engage(height=MAG_HEIGHT)
+            _settle()
+
+    for pip in [m300]:
+        ctx.comment(str(allocator.remaining(pip.tip_racks, pip.channels)) +
+                    ' tip pick-ups left for ' + pip.name + ' before its \
+tipracks need replacing.')
 
     """
     Here is where you can call the methods defined above to fit your specific
     protocol. The normal sequence is:
     """
-    # bind(binding_buffer_vol, park=park_tips)
-    wash(wash1_vol, wash1, park=park_tips)
-    wash(wash2_vol, wash2, park=park_tips)
+    # bind(binding_buffer_vol, park=park_tips, repark=predispense_reagents)
+    wash(wash1_vol, wash1, 'wash 1', park=park_tips,
+         repark=predispense_reagents)
+    wash(wash2_vol, wash2, 'wash 2', park=park_tips)
     elute(elution_vol, park=park_tips)
 
-    # track final used tip
-    if tip_track and not ctx.is_simulating():
+    # the run is complete, nothing left to resume
+    if checkpoint and not ctx.is_simulating() and \
+            os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    # write run profile
+    if profile and not ctx.is_simulating():
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
-        data = {'tips300': tip_log['count'][m300]}
-        with open(tip_file_path, 'w') as outfile:
-            json.dump(data, outfile)
+        with open(folder_path + '/run_profile.json', 'w') as outfile:
+            json.dump(profiler.report(), outfile)
@@ -2,6 +2,10 @@ from opentrons import protocol_api
 import json
 import os
 import math
+import sys
+from functools import wraps
+from time import time
+from types import MethodType
 
 # metadata
 metadata = {
@@ -14,6 +18,407 @@ metadata = {
 NUM_SAMPLES = 8  # start with 8 samples, slowly increase to 48, then 94 (max is 94)
 PREPARE_MASTERMIX = True
 TIP_TRACK = False
+PROFILE = False
+DISTRIBUTE_MASTERMIX = False
+MM_ACCURACY_BOUND = 1.0  # smallest mastermix dispense as a fraction of a pipette's minimum volume
+
+# how each liquid is pipetted, see LiquidClass
+LIQUID_CLASSES = {
+    'mastermix': {'delay': 3, 'air_gap': 20,
+                  'pipettes': {'p300_single_gen2': {'aspirate': 20}}},
+    'sample': {'air_gap': 2}  # eluates from Station B
+}
+
+# gantry speeds (mm/s) without and with liquid in the tip, see GantrySpeeds
+GANTRY_SPEEDS = {'empty': 600, 'loaded': 400}
+TRIP_MARGIN = 0  # µl of tip capacity left unused on every stroke, the filter tips are rated below the filter
+
+
+# Definitions for run profiling
+class RunProfiler:
+    """
+    `RunProfiler` records the wall-clock start and end of each wrapped
+    pipette, module and protocol context call, tagged with the phase of the
+    protocol it was made from. The phase is the innermost protocol function
+    that is not a helper, or `phase` for calls made directly from `run`.
+    """
+    PIPETTE_CALLS = ['transfer', 'distribute', 'mix', 'aspirate', 'dispense',
+                     'air_gap', 'blow_out', 'touch_tip', 'move_to',
+                     'pick_up_tip', 'drop_tip']
+    HELPERS = ['pick_up', 'drop', 'h_track', 'wait']
+
+    def __init__(self, protocol_file):
+        self.protocol_file = protocol_file
+        self.phase = 'setup'
+        self.calls = []
+        self._stack = []
+        self._paused = False
+
+    def wrap(self, obj, names):
+        for name in names:
+            if hasattr(obj, name):
+                setattr(obj, name, MethodType(
+                    self._timed(getattr(obj, name).__func__, name), obj))
+
+    def _current_phase(self):
+        frame = sys._getframe(2)
+        while frame:
+            name = frame.f_code.co_name
+            if frame.f_code.co_filename == self.protocol_file:
+                if name == 'run':
+                    break
+                if name not in self.HELPERS and \
+                        not name.startswith(('_', '<')):
+                    return name
+            frame = frame.f_back
+        return self.phase
+
+    def _timed(self, method, name):
+        @wraps(method)
+        def _timed_call(*args, **kwargs):
+            call = {'call': name, 'phase': self._current_phase(),
+                    'depth': len(self._stack), 'start': time(), 'nested': 0}
+            self._stack.append(call)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._stack.pop()
+                call['end'] = time()
+                duration = call['end'] - call['start']
+                call['self'] = duration - call.pop('nested')
+                if self._stack:
+                    self._stack[-1]['nested'] += duration
+                # the first robot move after a pause blocks until the
+                # operator resumes, so its time is spent waiting
+                call['operator'] = name == 'pause' or (
+                    self._paused and call['self'] == duration)
+                if call['operator'] and name != 'pause':
+                    self._paused = False
+                elif name == 'pause':
+                    self._paused = True
+                self.calls.append(call)
+        return _timed_call
+
+    def report(self):
+        phases = {}
+        call_types = {}
+        for call in self.calls:
+            phase = phases.setdefault(
+                call['phase'], {'robot': 0, 'operator': 0})
+            phase['operator' if call['operator'] else 'robot'] += call['self']
+            call_type = call_types.setdefault(
+                call['call'], {'count': 0, 'seconds': 0})
+            call_type['count'] += 1
+            call_type['seconds'] += call['self']
+        log = sorted(self.calls, key=lambda call: call['start'])
+        return {
+            'robot': sum(phase['robot'] for phase in phases.values()),
+            'operator': sum(phase['operator'] for phase in phases.values()),
+            'wall': log[-1]['end'] - log[0]['start'] if log else 0,
+            'phases': phases,
+            'calls': call_types,
+            'log': log
+        }
+
+
+# Definitions for module commands
+class ModuleCommand:
+    """
+    `ModuleCommand` is the handle of a module command that was started
+    without waiting for it to finish, so that the protocol can keep
+    pipetting and only wait where the result is needed. Waiting on a command
+    that has already been waited on returns immediately.
+    """
+
+    def __init__(self, wait):
+        self._wait = wait
+
+    @classmethod
+    def temperature(cls, tempdeck, celsius):
+        """
+        `temperature` starts ramping a temperature module to `celsius` and
+        returns the handle to await the target temperature with.
+        """
+        tempdeck.start_set_temperature(celsius)
+        return cls(lambda: tempdeck.await_temperature(celsius))
+
+    def wait(self):
+        if self._wait:
+            self._wait()
+            self._wait = None
+
+
+# Definitions for tip tracking
+class TipAllocator:
+    """
+    `TipAllocator` hands out tips from the tipracks of every pipette and
+    keeps an occupancy bitmap per rack, with racks identified by their deck
+    slot and bit i set once tip i (in `rack.wells()` order) is used.
+    Multichannel pipettes get full fresh columns from any rack, including
+    racks a single-channel pipette has broken. Single-channel pipettes take
+    tips from partly used columns and racks first, so that full columns stay
+    available to the multichannel.
+    When saving, every pick-up is appended to the ledger file as it happens,
+    so a crash, E-stop or cancelled run loses no tip state and the next run
+    starts at the next fresh tip. Every `COMPACT_EVERY` entries the file is
+    atomically replaced by a single snapshot entry.
+    """
+    COMPACT_EVERY = 100
+    FULL_COLUMN = 0xff
+
+    def __init__(self, path, save):
+        self.path = path
+        self.save = save
+        self.used = {}
+        self.entries = 0
+        if save and os.path.isfile(path):
+            with open(path) as ledger_file:
+                for line in ledger_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn by an interrupted write, drop it from the file
+                        self._compact()
+                        break
+                    self._apply(entry)
+                    self.entries += 1
+
+    def _apply(self, entry):
+        if 'snapshot' in entry:
+            self.used = {}
+            for slot, tips in entry['snapshot'].items():
+                self._mark(slot, tips)
+        elif 'reset' in entry:
+            for slot in entry['reset']:
+                self.used.pop(slot, None)
+        else:
+            self._mark(entry['slot'], entry['tips'])
+
+    def _mark(self, slot, tips):
+        for tip in tips:
+            self.used[slot] = self.used.get(slot, 0) | 1 << tip
+
+    def _write(self, path, mode, entry):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.mkdir(folder)
+        with open(path, mode) as ledger_file:
+            ledger_file.write(json.dumps(entry) + '\n')
+            ledger_file.flush()
+            os.fsync(ledger_file.fileno())
+
+    def _compact(self):
+        self._write(self.path + '.tmp', 'w', {'snapshot': self.snapshot()})
+        os.replace(self.path + '.tmp', self.path)
+        self.entries = 1
+
+    def _record(self, entry):
+        self._apply(entry)
+        if not self.save:
+            return
+        if self.entries >= self.COMPACT_EVERY:
+            self._compact()
+        else:
+            self._write(self.path, 'a', entry)
+            self.entries += 1
+
+    def next_tip(self, racks, channels=1):
+        """
+        `next_tip` returns the well to pick up tips from, or None if `racks`
+        hold no full column (multichannel) or no tip (single-channel).
+        :param racks (List[Labware]): The pipette's tipracks, in order.
+        :param channels (int): The number of channels of the pipette.
+        """
+        best = None
+        for order, rack in enumerate(racks):
+            used = self.used.get(rack.parent, 0)
+            for col in range(12):
+                col_used = used >> col*8 & self.FULL_COLUMN
+                if channels > 1:
+                    if col_used:
+                        continue
+                    key = (used == 0, order, col)
+                    index = col*8
+                else:
+                    if col_used == self.FULL_COLUMN:
+                        continue
+                    row = next(r for r in range(8) if not col_used >> r & 1)
+                    key = (col_used == 0, used == 0, order, col)
+                    index = col*8 + row
+                if best is None or key < best[0]:
+                    best = (key, rack, index)
+        return best[1].wells()[best[2]] if best else None
+
+    def remaining(self, racks, channels=1):
+        """
+        `remaining` returns the number of pick-ups left in `racks` before
+        they need replacing.
+        """
+        count = 0
+        for rack in racks:
+            used = self.used.get(rack.parent, 0)
+            if channels > 1:
+                count += sum(1 for col in range(12)
+                             if not used >> col*8 & self.FULL_COLUMN)
+            else:
+                count += 96 - bin(used).count('1')
+        return count
+
+    def use(self, tip, channels=1):
+        index = tip.parent.wells().index(tip)
+        self._record({'slot': tip.parent.parent,
+                      'tips': list(range(index, index + channels))})
+
+    def reset(self, racks):
+        self._record({'reset': [rack.parent for rack in racks]})
+
+    def snapshot(self):
+        return {slot: [i for i in range(96) if used >> i & 1]
+                for slot, used in self.used.items()}
+
+    def restore(self, snapshot):
+        """
+        `restore` marks the tips used in a saved `snapshot` as used, keeping
+        the tips used since it was taken.
+        """
+        for slot, tips in snapshot.items():
+            self._record({'slot': slot, 'tips': tips})
+
+
+# Definitions for liquid classes
+class LiquidClass:
+    """
+    `LiquidClass` is how a liquid is pipetted: its aspirate, dispense and
+    blow-out flow rates (µl/s, the pipette's own when not set), how many
+    seconds to wait after aspirating it for a viscous liquid to finish
+    entering the tip, the air gap (µl) it is carried with and the gantry
+    speed (mm/s) it is carried at, see `GantrySpeeds`. Settings that differ
+    for a pipette model are overridden under the model's name in `pipettes`.
+    The wait only follows aspirations the protocol makes itself, not those
+    of `transfer`.
+    """
+    RATES = ['aspirate', 'dispense', 'blow_out']
+
+    def __init__(self, aspirate=None, dispense=None, blow_out=None, delay=0,
+                 air_gap=0, speed=None, pipettes=None):
+        self.aspirate = aspirate
+        self.dispense = dispense
+        self.blow_out = blow_out
+        self.delay = delay
+        self.air_gap = air_gap
+        self.speed = speed
+        self.pipettes = pipettes or {}
+
+    def use(self, pip):
+        """
+        `use` sets the flow rates of `pip` for the liquid and returns the
+        liquid class with the settings for the pipette's model.
+        """
+        settings = dict(vars(self), pipettes=None)
+        settings.update(self.pipettes.get(pip.name, {}))
+        liquid = LiquidClass(**settings)
+        for action in self.RATES:
+            if getattr(liquid, action):
+                setattr(pip.flow_rate, action, getattr(liquid, action))
+        return liquid
+
+    def wait(self, ctx):
+        if self.delay:
+            ctx.delay(seconds=self.delay)
+
+
+# Definitions for gantry speeds
+class GantrySpeeds:
+    """
+    `GantrySpeeds` sets the gantry speed (mm/s) of every move of a wrapped
+    pipette from what its tip holds: `empty` without a tip or with an empty
+    tip, `loaded` with liquid in the tip, or the `speed` of the liquid class
+    the pipette carries, if it has one. An air gap alone does not load the
+    tip. The speed is set after each tip and plunger call, for the moves of
+    the next one.
+    """
+    CALLS = ['pick_up_tip', 'drop_tip', 'aspirate', 'dispense', 'blow_out']
+
+    def __init__(self, speeds):
+        self.empty = speeds.get('empty', 400)
+        self.loaded = speeds.get('loaded', 400)
+        self._carrying = {}
+
+    def wrap(self, pip):
+        for name in self.CALLS:
+            setattr(pip, name, MethodType(
+                self._setting_speed(getattr(pip, name).__func__), pip))
+        pip.air_gap = MethodType(
+            self._keeping_speed(pip.air_gap.__func__), pip)
+        pip.default_speed = self.empty
+
+    def _setting_speed(self, method):
+        @wraps(method)
+        def _set_speed(pip, *args, **kwargs):
+            result = method(pip, *args, **kwargs)
+            if pip.hw_pipette['has_tip'] and pip.current_volume > 0:
+                pip.default_speed = self._carrying.get(pip) or self.loaded
+            else:
+                pip.default_speed = self.empty
+            return result
+        return _set_speed
+
+    def _keeping_speed(self, method):
+        @wraps(method)
+        def _keep_speed(pip, *args, **kwargs):
+            speed = pip.default_speed
+            result = method(pip, *args, **kwargs)
+            pip.default_speed = speed
+            return result
+        return _keep_speed
+
+    def carry(self, pip, liquid):
+        """
+        `carry` applies the liquid class `liquid` to `pip`, see
+        `LiquidClass.use`, and moves the pipette at the speed of the liquid
+        while its tip is loaded.
+        """
+        liquid = liquid.use(pip)
+        self._carrying[pip] = liquid.speed
+        return liquid
+
+
+# Definitions for trip planning
+class TripPlanner:
+    """
+    `TripPlanner` splits a transfer into the fewest strokes that fit the tip,
+    all of the same volume. A stroke holds the volume of the tips the pipette
+    is loaded with (never more than the pipette's own or the `tip_volume`
+    (µl) the tips are known to hold), less the air gaps of the liquid class
+    it is carried with and a safety `margin` (µl).
+    """
+
+    def __init__(self, margin=0, tip_volume=None):
+        self.margin = margin
+        self.tip_volume = tip_volume
+
+    def capacity(self, pip, liquid=None, air_gaps=1):
+        """
+        `capacity` returns the largest volume a stroke of `pip` can carry.
+        :param pip (InstrumentContext): The pipette.
+        :param liquid (LiquidClass): The liquid class the stroke is carried
+                                     with, if any.
+        :param air_gaps (int): How many air gaps of the liquid the tip holds
+                               next to the stroke.
+        """
+        tip_vol = min([pip.max_volume] + [
+            rack.wells()[0].max_volume for rack in pip.tip_racks] + (
+            [self.tip_volume] if self.tip_volume else []))
+        air_gap = liquid.air_gap if liquid else 0
+        return tip_vol - air_gaps*air_gap - self.margin
+
+    def strokes(self, pip, vol, liquid=None, air_gaps=1):
+        """
+        `strokes` returns the volume of each stroke of a transfer of `vol`.
+        """
+        capacity = self.capacity(pip, liquid, air_gaps)
+        num_strokes = max(math.ceil(round(vol/capacity, 6)), 1)
+        return [vol/num_strokes]*num_strokes
 
 
 def run(ctx: protocol_api.ProtocolContext):
@@ -31,7 +436,6 @@ def run(ctx: protocol_api.ProtocolContext):
     tempdeck = ctx.load_module('Temperature Module Gen2', '4')
     pcr_plate = tempdeck.load_labware(
         'opentrons_96_aluminumblock_nest_wellplate_100ul', 'PCR plate')
-    tempdeck.set_temperature(4)
     tube_block = ctx.load_labware(
         'opentrons_24_aluminumblock_nest_2ml_screwcap', '5',
         '2ml screw tube aluminum block for mastermix + controls')
@@ -39,50 +443,47 @@ def run(ctx: protocol_api.ProtocolContext):
     # pipette
     p20 = ctx.load_instrument('p20_single_gen2', 'right', tip_racks=tips20)
     p300 = ctx.load_instrument('p300_single_gen2', 'left', tip_racks=tips300)
-    p300.flow_rate.aspirate = 20
+    liquids = {name: LiquidClass(**settings)
+               for name, settings in LIQUID_CLASSES.items()}
+    planner = TripPlanner(TRIP_MARGIN)
+    liquids['mastermix'].use(p300)  # the P300 only pipettes mastermix
+
+    speeds = GantrySpeeds(GANTRY_SPEEDS)
+    for pip in [p20, p300]:
+        speeds.wrap(pip)
+
+    profiler = RunProfiler(run.__code__.co_filename)
+    if PROFILE:
+        profiler.wrap(ctx, ['delay', 'pause', 'home'])
+        profiler.wrap(tempdeck, ['set_temperature', 'await_temperature'])
+        for pip in [p20, p300]:
+            profiler.wrap(pip, RunProfiler.PIPETTE_CALLS)
+
+    cooling = ModuleCommand.temperature(tempdeck, 4)
 
     # setup up sample sources and destinations
     sources = source_plate.wells()[:NUM_SAMPLES]
     sample_dests = pcr_plate.wells()[:NUM_SAMPLES]
 
-    tip_log = {'count': {}}
     folder_path = '/data/C'
-    tip_file_path = folder_path + '/tip_log.json'
-    if TIP_TRACK and not ctx.is_simulating():
-        if os.path.isfile(tip_file_path):
-            with open(tip_file_path) as json_file:
-                data = json.load(json_file)
-                if 'tips20' in data:
-                    tip_log['count'][p20] = data['tips20']
-                else:
-                    tip_log['count'][p20] = 0
-                if 'tips300' in data:
-                    tip_log['count'][p300] = data['tips300']
-                else:
-                    tip_log['count'][p300] = 0
-        else:
-            tip_log['count'] = {p20: 0, p300: 0}
-    else:
-        tip_log['count'] = {p20: 0, p300: 0}
-
-    tip_log['tips'] = {
-        p20: [tip for rack in tips20 for tip in rack.wells()],
-        p300: [tip for rack in tips300 for tip in rack.wells()]
-    }
-    tip_log['max'] = {
-        pip: len(tip_log['tips'][pip])
-        for pip in [p20, p300]
-    }
+    allocator = TipAllocator(folder_path + '/tip_ledger.jsonl',
+                             TIP_TRACK and not ctx.is_simulating())
 
     def pick_up(pip):
-        nonlocal tip_log
-        if tip_log['count'][pip] == tip_log['max'][pip]:
+        tip = allocator.next_tip(pip.tip_racks, pip.channels)
+        if tip is None:
             ctx.pause('Replace ' + str(pip.max_volume) + 'µl tipracks before \
 resuming.')
             pip.reset_tipracks()
-            tip_log['count'][pip] = 0
-        pip.pick_up_tip(tip_log['tips'][pip][tip_log['count'][pip]])
-        tip_log['count'][pip] += 1
+            allocator.reset(pip.tip_racks)
+            tip = allocator.next_tip(pip.tip_racks, pip.channels)
+        pip.pick_up_tip(tip)
+        allocator.use(tip, pip.channels)
+
+    for pip in [p20, p300]:
+        ctx.comment(str(allocator.remaining(pip.tip_racks, pip.channels)) +
+                    ' tip pick-ups left for ' + pip.name + ' before its \
+tipracks need replacing.')
 
     """ mastermix component maps """
     mm_tube = tube_block.wells()[0]
@@ -105,6 +506,58 @@ resuming.')
         mm_height = mm_height - dh if mm_height - dh > 2 else 2  # stop at 2mm above mm tube bottom
         return mm_tube.bottom(mm_height)
 
+    def plan_strokes(vol, num_dests, capacity, disposal_vol):
+        """
+        `plan_strokes` splits the dispenses into `num_dests` wells into
+        multi-dispense strokes that fit the tip next to the disposal volume.
+        Wells are spread evenly so the last stroke is not left short.
+        :param vol (float): The volume to dispense into each well.
+        :param num_dests (int): The number of destination wells.
+        :param capacity (float): The usable volume of the tip.
+        :param disposal_vol (float): The volume kept back in each stroke.
+        :return (List[int]): The number of wells served by each stroke.
+        """
+        per_stroke = max(int((capacity - disposal_vol)//vol), 1)
+        num_strokes = math.ceil(num_dests/per_stroke)
+        base, extra = divmod(num_dests, num_strokes)
+        return [base + 1 if i < extra else base for i in range(num_strokes)]
+
+    def distribute_mastermix(vol, dests, pipettes):
+        """
+        `distribute_mastermix` fills each destination with mastermix in
+        multi-dispense strokes with a single tip. Of the pipettes that are
+        accurate at `vol` (within MM_ACCURACY_BOUND of their minimum volume)
+        the one needing the fewest trips to the mastermix tube is used. Each
+        stroke carries a disposal volume of a tenth of the tip capacity, which
+        is blown back into the tube when the stroke serves several wells.
+        :param vol (float): The volume of mastermix for each destination.
+        :param dests (List[Well]): The wells to fill.
+        :param pipettes (List[InstrumentContext]): The candidate pipettes.
+        """
+        eligible = [
+            pip for pip in pipettes if vol >= pip.min_volume*MM_ACCURACY_BOUND]
+        if not eligible:
+            eligible = [min(pipettes, key=lambda pip: pip.min_volume)]
+        pip = min(eligible, key=lambda pip: (len(plan_strokes(
+            vol, len(dests), planner.capacity(pip), planner.capacity(pip)/10)),
+            pip.max_volume))
+        disposal_vol = planner.capacity(pip)/10
+        if not pip.hw_pipette['has_tip']:
+            pick_up(pip)
+        i = 0
+        for num_wells in plan_strokes(
+                vol, len(dests), planner.capacity(pip), disposal_vol):
+            extra_vol = disposal_vol if num_wells > 1 else 0
+            pip.aspirate(vol*num_wells + extra_vol, h_track(vol*num_wells))
+            for d in dests[i:i+num_wells]:
+                pip.dispense(vol, d)
+            if extra_vol:
+                pip.blow_out(mm_tube.top())  # disposal volume back to the tube
+            i += num_wells
+        pip.drop_tip()
+
+    # prepare mastermix
+    profiler.phase = 'mastermix prep'
     if PREPARE_MASTERMIX:
         vol_overage = 1.2 if NUM_SAMPLES > 48 else 1.1  # decrease overage for small sample number
 
@@ -112,17 +565,17 @@ resuming.')
             comp_vol = vol*(NUM_SAMPLES+2)*vol_overage
             pip = p300 if comp_vol > 20 else p20
             pick_up(pip)
-            num_trans = math.ceil(comp_vol/160)
-            vol_per_trans = comp_vol/num_trans
-            for _ in range(num_trans):
-                pip.air_gap(20)
+            mastermix = speeds.carry(pip, liquids['mastermix'])
+            for vol_per_trans in planner.strokes(
+                    pip, comp_vol, mastermix, air_gaps=2):
+                pip.air_gap(mastermix.air_gap)
                 pip.aspirate(vol_per_trans, tube)
-                ctx.delay(seconds=3)
+                mastermix.wait(ctx)
                 pip.touch_tip(tube)
-                pip.air_gap(20)
-                pip.dispense(20, mm_tube.top())  # void air gap
+                pip.air_gap(mastermix.air_gap)
+                pip.dispense(mastermix.air_gap, mm_tube.top())  # void air gap
                 pip.dispense(vol_per_trans, mm_tube.bottom(2))
-                pip.dispense(20, mm_tube.top())  # void pre-loaded air gap
+                pip.dispense(mastermix.air_gap, mm_tube.top())  # void pre-loaded air gap
                 pip.blow_out(mm_tube.top())
                 pip.touch_tip(mm_tube)
             if i < len(mm_dict['components'].items()) - 1 or pip == p20:  # only keep tip if last component and p300 in use
@@ -138,35 +591,39 @@ resuming.')
         p300.drop_tip()
 
     # transfer mastermix to TD plate
+    profiler.phase = 'mastermix distribution'
+    cooling.wait()
     mm_vol = mm_dict['volume']
-    pick_up(p20)
-    for d in sample_dests:
-        p20.air_gap(20-mm_vol)
-        p20.aspirate(mm_vol, h_track(mm_vol))
-        p20.dispense(20, d)
-    p20.drop_tip()
+    if DISTRIBUTE_MASTERMIX:
+        distribute_mastermix(mm_vol, sample_dests, [p20, p300])
+    else:
+        pick_up(p20)
+        for d in sample_dests:
+            p20.air_gap(20-mm_vol)
+            p20.aspirate(mm_vol, h_track(mm_vol))
+            p20.dispense(20, d)
+        p20.drop_tip()
 
     # transfer samples to corresponding locations
+    profiler.phase = 'sample transfer'
     sample_vol = 20 - mm_vol
+    sample = speeds.carry(p20, liquids['sample'])
     for s, d in zip(sources, sample_dests):
         pick_up(p20)
         p20.air_gap(10)
         p20.aspirate(sample_vol, s.bottom(2))
-        p20.air_gap(2)
-        p20.dispense(2, d.top())  # void air gap
+        sample.wait(ctx)
+        p20.air_gap(sample.air_gap)
+        p20.dispense(sample.air_gap, d.top())  # void air gap
         p20.dispense(10+sample_vol, d.bottom(2))
         p20.mix(1, 10, d.bottom(2))
         p20.blow_out(d.top(-2))
         p20.aspirate(5, d.top(2))  # suck in any remaining droplets on way to trash
         p20.drop_tip()
 
-    # track final used tip
-    if TIP_TRACK and not ctx.is_simulating():
+    # write run profile
+    if PROFILE and not ctx.is_simulating():
         if not os.path.isdir(folder_path):
             os.mkdir(folder_path)
-        data = {
-            'tips20': tip_log['count'][p20],
-            'tips300': tip_log['count'][p300]
-        }
-        with open(tip_file_path, 'w') as outfile:
-            json.dump(data, outfile)
+        with open(folder_path + '/run_profile.json', 'w') as outfile:
+            json.dump(profiler.report(), outfile)
@@ -0,0 +1,156 @@
+"""
+Benchmark all station protocols in simulation across sample counts.
+
+For every protocol and sample count the command count, tips used per pipette,
+tips dropped in the trash, liquid moved, number of `ctx.pause` interruptions
+and estimated walltime are recorded. Results are compared against a baseline file and the run fails when
+a metric regresses beyond the threshold.
+
+Usage:
+    python tools/benchmark.py              # compare against the baseline
+    python tools/benchmark.py --update     # write a new baseline
+"""
+import argparse
+import json
+import os
+import sys
+from collections import OrderedDict
+
+from estimate_runtime import simulate, summarize
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'benchmark_baseline.json')
+
+"""
+Protocols to benchmark: (path, sample count parameter, maximum samples)
+"""
+PROTOCOLS = [
+    ('Station A/BP Purebase P1000S/v1_station_a_S9_bp_purebase.py',
+     'NUM_SAMPLES', 96),
+    ('Station A/BP Purebase P300S 10ul IC/v1_station_a_S9_bp_purebase.py',
+     'NUM_SAMPLES', 96),
+    ('Station A/BP Purebase P300S 20ul IC/v2_station_a_S9_bp_purebase.py',
+     'NUM_SAMPLES', 96),
+    ('Station B/BP Purebase 400µl Input with Tip Parking/\
+v1_station_b_S9_bp_purebase_400ulinput.py', 'NUM_SAMPLES', 94),
+    ('Station B/BP Purebase 400µl Input without Tip Parking/\
+v1_station_b_S9_bp_purebase_400ulinput.py', 'NUM_SAMPLES', 94),
+    ('Station B/Thermo Fisher/v1_s9_station_b_thermo.py',
+     'num_samples', 96),
+    ('Station C/BP PrimerDesign P20 Multi/\
+v1_station_c_S9_bp_primerdesign_p20multi.py', 'NUM_SAMPLES', 94),
+    ('Station C/BP PrimerDesign P20 Single/\
+v1_station_c_S9_bp_primerdesign_p20single.py', 'NUM_SAMPLES', 94)
+]
+SAMPLE_COUNTS = [8, 24, 48]
+
+# metrics for which any change beyond the threshold is reported, not only
+# an increase
+EXACT_METRICS = ['liquid']
+
+
+def measure(path, params):
+    """
+    `measure` simulates a protocol and returns its benchmark metrics.
+    :param path (str): Path to the protocol file, relative to the repository.
+    :param params (dict): Module-level parameters to override.
+    """
+    records = simulate(os.path.join(REPO, path), params)
+    summary = summarize(records)
+    tips = {}
+    trash = 0
+    liquid = 0
+    for record in records:
+        if record['command'] == 'PICK_UP_TIP' and record['fresh']:
+            tips[record['instrument']] = tips.get(
+                record['instrument'], 0) + record['channels']
+        elif record['command'] == 'DROP_TIP' and not record['parked']:
+            trash += record['channels']
+        elif record['command'] == 'ASPIRATE' and \
+                record['parent'] != 'AIR_GAP':
+            liquid += record['volume']*record['channels']
+    metrics = OrderedDict()
+    metrics['commands'] = len(records)
+    for instrument in sorted(tips):
+        metrics['tips ' + instrument] = tips[instrument]
+    metrics['trash'] = trash
+    metrics['liquid'] = round(liquid, 1)
+    metrics['pauses'] = summary['total']['pauses']
+    metrics['walltime'] = round(summary['total']['seconds'])
+    return metrics
+
+
+def run_benchmarks(protocols=None):
+    results = OrderedDict()
+    for path, param, max_samples in PROTOCOLS:
+        if protocols and not any(name in path for name in protocols):
+            continue
+        for num_samples in SAMPLE_COUNTS + [max_samples]:
+            key = path + ' @ ' + str(num_samples)
+            sys.stderr.write('simulating ' + key + '\n')
+            results[key] = measure(path, {param: num_samples})
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    `compare` returns a list of regressions of `results` against `baseline`.
+    :param threshold (float): Allowed relative increase, e.g. 0.05 for 5%.
+    """
+    regressions = []
+    for key, metrics in results.items():
+        if key not in baseline:
+            continue
+        for metric, value in metrics.items():
+            base = baseline[key].get(metric)
+            if base is None:
+                continue
+            limit = abs(base)*threshold
+            if value > base + limit or (
+                    metric in EXACT_METRICS and value < base - limit):
+                regressions.append(
+                    key + ': ' + metric + ' ' + str(base) + ' -> ' +
+                    str(value))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark station protocols in simulation.')
+    parser.add_argument('--update', action='store_true',
+                        help='write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='allowed relative regression (default 0.05)')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline file (default: %(default)s)')
+    parser.add_argument('--only', action='append', metavar='TEXT',
+                        help='only benchmark protocols whose path contains '
+                             'TEXT')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.only)
+    if args.update:
+        baseline = OrderedDict()
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, encoding='utf-8') as baseline_file:
+                baseline.update(json.load(
+                    baseline_file, object_pairs_hook=OrderedDict))
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, ensure_ascii=False)
+            baseline_file.write('\n')
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as baseline_file:
+        baseline = json.load(baseline_file)
+    json.dump(results, sys.stdout, indent=2, ensure_ascii=False)
+    sys.stdout.write('\n')
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        sys.stderr.write('REGRESSION ' + regression + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
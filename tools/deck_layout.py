@@ -0,0 +1,316 @@
+"""
+Propose a deck layout and well visit order that shorten the gantry travel of
+a station protocol.
+
+The protocol is executed against the Opentrons simulator with the parameters
+it will be run with, and every move it makes is recorded by the deck slot it
+goes to and where in that slot it ends up. The moves are then replayed with
+the labware and modules of each slot moved to other slots, and priced with
+the travel part of the `estimate_runtime.py` timing model. Slots are swapped
+pairwise for as long as a swap shortens the travel, keeping the fixed trash
+in slot 12, modules in the slots they fit in and any slot given with --fix.
+
+For the visit order, the tip cycles of each step (from a tip pick-up to its
+drop) are reordered by nearest neighbour. A cycle keeps its own wells, so a
+sample still goes to its well, and fresh tips are still picked up in rack
+order. Steps whose reordered cycles save less than a second are not listed.
+
+The proposal is only a starting point: check reach, heights, heat and
+cabling of the new layout before changing the `load_labware` and
+`load_module` slots of the protocol.
+
+Usage:
+    python tools/deck_layout.py "Station A/BP Purebase P1000S/\
+v1_station_a_S9_bp_purebase.py" --set NUM_SAMPLES=96
+"""
+import argparse
+import sys
+from collections import OrderedDict
+
+from estimate_runtime import (RunRecorder, _labware, _point, load_protocol,
+                              parse_params, travel_time)
+
+DECK_SLOTS = [str(slot) for slot in range(1, 12)]
+TRASH_SLOT = '12'
+
+# slots the magnetic and temperature modules fit in
+MODULE_SLOTS = ['1', '3', '4', '6', '7', '9', '10']
+
+# commands that move the pipette to their location
+MOVE_COMMANDS = ['ASPIRATE', 'DISPENSE', 'PICK_UP_TIP', 'DROP_TIP',
+                 'RETURN_TIP', 'BLOW_OUT']
+
+
+def _slot(labware):
+    """ Return the deck slot a well, labware or module sits in. """
+    item = labware
+    while item is not None and not isinstance(item, str):
+        item = getattr(item, 'parent', None)
+    return item
+
+
+class MoveRecorder(RunRecorder):
+    """
+    `MoveRecorder` records every move of a protocol relative to the deck
+    slot it goes to, so that it can be replayed in another layout.
+    """
+
+    def __init__(self, path, deck):
+        super().__init__(path)
+        self.deck = deck
+        self.moves = []
+
+    def on_command(self, message):
+        super().on_command(message)
+        if message['$'] == 'after':
+            return
+        kind = message['name'].split('.')[-1]
+        payload = message['payload']
+        if kind == 'HOME':
+            self.moves.append(None)
+        if kind not in MOVE_COMMANDS:
+            return
+        location = payload.get('location')
+        point = _point(location)
+        labware = _labware(location)
+        slot = _slot(labware)
+        if point is None or slot is None:
+            return
+        origin = self.deck.position_for(slot).point
+        self.moves.append({
+            'slot': slot,
+            'offset': (point[0] - origin.x, point[1] - origin.y, point[2]),
+            'labware': id(labware),
+            'well': not hasattr(labware, 'wells'),
+            'speed': getattr(payload.get('instrument'), 'default_speed',
+                             None),
+            'step': self.records[-1]['step'],
+            'pick_up': kind == 'PICK_UP_TIP',
+            'fresh': self.records[-1].get('fresh', False),
+            'drop': kind in ['DROP_TIP', 'RETURN_TIP']
+        })
+
+
+def travel(moves, origins, layout, timing):
+    """
+    `travel` returns the seconds of gantry travel of `moves` with the
+    contents of each slot moved to the slot `layout` maps it to.
+    :param moves (List[dict]): Moves recorded by `MoveRecorder`, `None` where
+                               the robot homes.
+    :param origins (dict): The x, y coordinates of every deck slot.
+    :param layout (dict): The proposed slot of each current slot.
+    :param timing (dict): The timing model.
+    """
+    seconds = 0
+    previous = position = None
+    for move in moves:
+        if move is None:
+            previous = position = None
+            continue
+        x, y = origins[layout.get(move['slot'], move['slot'])]
+        point = (x + move['offset'][0], y + move['offset'][1],
+                 move['offset'][2])
+        if previous is not None and point != position:
+            same = move['labware'] == previous['labware']
+            seconds += travel_time(timing, position, point, same,
+                                   same and move['well'], move['speed'])
+        previous, position = move, point
+    return seconds
+
+
+def _allowed(layout, modules, fixed):
+    return all(layout[slot] in MODULE_SLOTS for slot in modules) and \
+        all(layout[slot] == slot for slot in fixed)
+
+
+def optimise_layout(moves, origins, modules, fixed, timing):
+    """
+    `optimise_layout` swaps the contents of deck slots pairwise for as long
+    as a swap shortens the travel and returns the best layout found.
+    :param modules (List[str]): Current slots holding modules.
+    :param fixed (List[str]): Current slots that must not move.
+    """
+    layout = {slot: slot for slot in DECK_SLOTS}
+    best = travel(moves, origins, layout, timing)
+    improved = True
+    while improved:
+        improved = False
+        best_swap = None
+        for i, a in enumerate(DECK_SLOTS):
+            for b in DECK_SLOTS[i+1:]:
+                trial = dict(layout)
+                trial[a], trial[b] = layout[b], layout[a]
+                if not _allowed(trial, modules, fixed):
+                    continue
+                seconds = travel(moves, origins, trial, timing)
+                if seconds < best - 1e-6:
+                    best, best_swap = seconds, trial
+        if best_swap:
+            layout = best_swap
+            improved = True
+    return layout, best
+
+
+def _cycles(moves):
+    """
+    Split moves into steps of consecutive tip cycles, each from a tip pick-up
+    to the drop of that tip. Moves outside of a cycle end the run of cycles.
+    """
+    runs = []
+    cycle = None
+    for move in moves:
+        if move is not None and move['pick_up']:
+            cycle = [move]
+            continue
+        if cycle is None:
+            runs.append((None, [move]))
+            continue
+        cycle.append(move)
+        if move is not None and move['drop']:
+            step = cycle[0]['step']
+            if runs and runs[-1][0] == step:
+                runs[-1][1].append(cycle)
+            else:
+                runs.append((step, [cycle]))
+            cycle = None
+    return runs
+
+
+def optimise_order(moves, origins, timing):
+    """
+    `optimise_order` reorders the tip cycles of each step by nearest
+    neighbour and returns, per step, the travel before and after and the new
+    order of its cycles. Fresh tips are picked up in the same order whatever
+    the cycle, parked tips stay with the cycle that parked them, and steps
+    that mix the two keep their order.
+    """
+    orders = OrderedDict()
+    for step, cycles in _cycles(moves):
+        if step is None or len(cycles) < 2:
+            continue
+        fresh = [cycle[0]['fresh'] for cycle in cycles]
+        if any(fresh) and not all(fresh):
+            continue
+        tips = [cycle[0] for cycle in cycles]
+
+        def _visit(i, k):
+            return [tips[k]] + cycles[i][1:] if fresh[i] else cycles[i]
+
+        placed = []
+        order = []
+        remaining = list(range(len(cycles)))
+        for k in range(len(cycles)):
+            # ties keep the recorded order
+            best = min(remaining, key=lambda i: (round(travel(
+                placed[-1:] + _visit(i, k)[:2], origins, {}, timing), 6), i))
+            placed.extend(_visit(best, k))
+            order.append(best)
+            remaining.remove(best)
+        name = step
+        while name in orders:
+            name += "'"
+        orders[name] = {
+            'before': travel([move for cycle in cycles for move in cycle],
+                             origins, {}, timing),
+            'after': travel(placed, origins, {}, timing),
+            'order': order
+        }
+    return orders
+
+
+def propose(path, params=None, fixed=None):
+    """
+    `propose` simulates a protocol and returns its current and proposed
+    layout and visit order.
+    :param path (str): Path to the protocol file.
+    :param params (dict): Module-level parameters to override.
+    :param fixed (List[str]): Slots whose contents must not move.
+    """
+    from opentrons import simulate as ot_simulate
+
+    protocol = load_protocol(path, params)
+    ctx = ot_simulate.get_protocol_api(protocol.metadata['apiLevel'])
+    recorder = MoveRecorder(path, ctx.deck)
+    unsubscribe = ctx.broker.subscribe('command', recorder.on_command)
+    try:
+        protocol.run(ctx)
+    finally:
+        unsubscribe()
+
+    origins = {}
+    for slot in DECK_SLOTS + [TRASH_SLOT]:
+        point = ctx.deck.position_for(slot).point
+        origins[slot] = (point.x, point.y)
+    contents = OrderedDict()
+    modules = []
+    for slot in DECK_SLOTS:
+        item = ctx.deck[slot]
+        if item is None:
+            contents[slot] = '-'
+        elif hasattr(item, 'wells'):
+            contents[slot] = item.name
+        else:
+            modules.append(slot)
+            labware = item.labware
+            contents[slot] = item.load_name + (
+                ' with ' + labware.name if labware else '')
+    timing = recorder.timing
+    current = travel(recorder.moves, origins, {}, timing)
+    layout, proposed = optimise_layout(
+        recorder.moves, origins, modules, fixed or [], timing)
+    return OrderedDict([
+        ('travel', current),
+        ('contents', contents),
+        ('layout', layout),
+        ('proposed travel', proposed),
+        ('visit order', optimise_order(recorder.moves, origins, timing))
+    ])
+
+
+def _format_seconds(seconds):
+    return '{:.0f} s'.format(seconds)
+
+
+def print_report(report, out=sys.stdout):
+    out.write('{:<6}{:<64}{}\n'.format('slot', 'contents', 'proposed slot'))
+    for slot, contents in report['contents'].items():
+        new = report['layout'][slot]
+        out.write('{:<6}{:<64}{}\n'.format(
+            slot, contents[:63], new if new != slot else '-'))
+    saved = report['travel'] - report['proposed travel']
+    out.write('\ntravel: ' + _format_seconds(report['travel']) +
+              ', with the proposed layout ' +
+              _format_seconds(report['proposed travel']) +
+              ' (' + _format_seconds(saved) + ' less)\n')
+    orders = [(step, order) for step, order in report['visit order'].items()
+              if order['before'] - order['after'] >= 1]
+    if not orders:
+        out.write('\nvisit order: no step saves a second by reordering its '
+                  'tip cycles\n')
+        return
+    out.write('\nvisit order:\n')
+    for step, order in orders:
+        out.write('  ' + step + ': ' + _format_seconds(order['before']) +
+                  ' -> ' + _format_seconds(order['after']) +
+                  ', cycles in order ' +
+                  ', '.join(str(i + 1) for i in order['order']) + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Propose a deck layout and well visit order that shorten '
+                    'the gantry travel of a station protocol.')
+    parser.add_argument('protocol', help='path to the protocol file')
+    parser.add_argument('--set', action='append', metavar='NAME=VALUE',
+                        help='override a module-level protocol parameter')
+    parser.add_argument('--fix', action='append', metavar='SLOT', default=[],
+                        help='keep the contents of a slot where they are')
+    args = parser.parse_args(argv)
+
+    report = propose(args.protocol, parse_params(args.set), args.fix)
+    print_report(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
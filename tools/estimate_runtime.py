@@ -0,0 +1,446 @@
+"""
+Estimate the walltime of a station protocol before it is run on a robot.
+
+The protocol is executed against the Opentrons simulator and every command it
+issues is priced with a simple per-command timing model: gantry travel between
+locations, plunger time from the pipette's configured flow rates, tip pick-up
+and drop, blow-outs, module moves and `ctx.delay` durations. Temperatures
+started with `start_set_temperature` ramp in the background and only cost
+time where the protocol awaits them. The protocol's `time` reads the estimated
+clock, so settling steps it times itself only cost the time left of them.
+Time spent waiting for the operator in `ctx.pause` cannot be predicted and is
+reported separately.
+
+Usage:
+    python tools/estimate_runtime.py "Station B/Thermo Fisher/\
+v1_s9_station_b_thermo.py" --set num_samples=48 --set mix_reps=5
+
+Any module-level parameter of the protocol (`NUM_SAMPLES`, `num_samples`,
+`STARTING_VOL`, `settling_time`, `PARK`, ...) can be overridden with --set.
+"""
+import argparse
+import ast
+import importlib.util
+import inspect
+import json
+import math
+import os
+import sys
+from collections import OrderedDict
+
+"""
+Timing model. Durations are in seconds, speeds in mm/s. These are defaults
+for an OT-2 with gen2 pipettes and should be calibrated against real runs.
+"""
+TIMING = {
+    'gantry_speed': 400,     # default speed of the pipette
+    'x_max_speed': 600,      # axis speed limits, moves faster than these
+    'y_max_speed': 400,      # are slowed down to them
+    'z_speed': 125,          # z speed limit
+    'arc_z': 120,            # height of the arc between different labware
+    'arc_clearance': 10,     # arc clearance between wells of one labware
+    'move_overhead': 0.3,    # acceleration and settling per move
+    'plunger_overhead': 0.3,  # per aspirate or dispense stroke
+    'pick_up_tip': 3.0,
+    'drop_tip': 2.5,
+    'blow_out': 1.0,
+    'touch_tip': 2.0,
+    'home': 8.0,
+    'magdeck': 4.0,
+    'temp_ramp': 0.1,        # °C/s reached by an aluminum block
+    'ambient_temp': 25.0
+}
+
+# commands that only group nested commands and take no time of their own
+CONTAINER_COMMANDS = ['TRANSFER', 'DISTRIBUTE', 'CONSOLIDATE', 'MIX',
+                      'AIR_GAP']
+
+# protocol helpers whose commands are attributed to the calling step
+HELPER_FUNCTIONS = ['pick_up', 'drop', 'h_track', 'waste_track', 'settle',
+                    'mix', 'wait', 'load']
+
+
+def parse_value(text):
+    """
+    `parse_value` converts a command line parameter value to a Python value.
+    :param text (str): The value, e.g. '48', '0.8', 'True' or 'foo'.
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def load_protocol(path, params=None):
+    """
+    `load_protocol` imports a protocol file and overrides its module-level
+    parameters before `run` is called.
+    :param path (str): Path to the protocol file.
+    :param params (dict): Parameter names and values to override. Names must
+                          already exist in the protocol.
+    """
+    spec = importlib.util.spec_from_file_location(
+        'protocol', os.path.abspath(path))
+    protocol = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(protocol)
+    for name, value in (params or {}).items():
+        if not hasattr(protocol, name):
+            raise ValueError(
+                'Unknown parameter ' + name + ' for ' + path)
+        setattr(protocol, name, value)
+    return protocol
+
+
+def _is_prose(comment):
+    """ Tell a descriptive comment from commented-out code. """
+    if comment.startswith(' ') or comment.endswith((',', '(')) \
+            or ' = ' in comment:
+        return False
+    try:
+        compile(comment, '<comment>', 'exec')
+    except SyntaxError:
+        return True
+    return False
+
+
+def _step_labels(path):
+    """
+    Map each line of a protocol to the nearest preceding full-line comment
+    in the body of `run`, so that commands issued directly from `run` can be
+    attributed to a step such as 'transfer sample'.
+    """
+    labels = {}
+    label = 'setup'
+    with open(path, encoding='utf-8') as protocol_file:
+        for lineno, line in enumerate(protocol_file, start=1):
+            if line.startswith('    # ') and _is_prose(line.strip()[2:]):
+                label = line.strip()[2:]
+            elif line.startswith('    def '):
+                label = 'setup'
+            labels[lineno] = label
+    return labels
+
+
+def _point(location):
+    """ Return the x, y, z coordinates of a `Location` or `Well`. """
+    if location is None:
+        return None
+    if hasattr(location, 'point'):
+        point = location.point
+    else:
+        point = location.top().point
+    return (point.x, point.y, point.z)
+
+
+def _labware(location):
+    if hasattr(location, 'labware'):
+        return _well(location)
+    return getattr(location, 'parent', None)
+
+
+def _started_without_waiting():
+    """
+    Tell a `start_set_temperature` command, which returns before the target
+    is reached, from a blocking `set_temperature`: both publish the same
+    command.
+    """
+    frame = inspect.currentframe()
+    while frame:
+        # the publishing decorator holds the method as `f` before opentrons
+        # 4.0 and as `func` from it
+        func = frame.f_locals.get('f') or frame.f_locals.get('func')
+        if getattr(func, '__name__', None) == 'start_set_temperature':
+            return True
+        frame = frame.f_back
+    return False
+
+
+def _well(location):
+    """ Return the well targeted by a `Location` or `Well`. """
+    if not hasattr(location, 'labware'):
+        return location
+    # from opentrons 4.0 a Location wraps its well in a LabwareLike
+    return getattr(location.labware, 'object', location.labware)
+
+
+def travel_time(timing, start, end, same_labware, direct, speed=None):
+    """
+    `travel_time` prices a move of the gantry from `start` to `end`.
+    :param timing (dict): The timing model.
+    :param start, end (tuple): The x, y, z coordinates of the move.
+    :param same_labware (boolean): Whether the move stays within one labware,
+                                   which arcs at clearance height only.
+    :param direct (boolean): Whether the move stays within one well, which
+                             does not arc at all.
+    :param speed (float): The gantry speed of the pipette, if set.
+    """
+    x0, y0, z0 = start
+    x1, y1, z1 = end
+    if same_labware:
+        arc = max(z0, z1) + timing['arc_clearance']
+    else:
+        arc = max(z0, z1, timing['arc_z'])
+    xy = math.hypot(x1 - x0, y1 - y0)
+    if xy and not direct:
+        vertical = (arc - z0) + (arc - z1)
+    else:
+        vertical = abs(z1 - z0)
+    speed = speed or timing['gantry_speed']
+    return (max(xy/speed, abs(x1 - x0)/timing['x_max_speed'],
+                abs(y1 - y0)/timing['y_max_speed'])
+            + vertical/min(speed, timing['z_speed'])
+            + timing['move_overhead'])
+
+
+class RunRecorder:
+    """
+    `RunRecorder` subscribes to the command broker of a protocol context and
+    prices every command with the timing model.
+    """
+
+    def __init__(self, path, timing=None):
+        self.path = os.path.abspath(path)
+        self.timing = dict(TIMING, **(timing or {}))
+        self.labels = _step_labels(path)
+        self.records = []
+        self._stack = []
+        self._position = None
+        self._labware = None
+        self._temperature = self.timing['ambient_temp']
+        self._temperature_reached = 0
+        self._clock = 0
+        self._parked = set()
+
+    def step(self):
+        """
+        Return the protocol step currently executing: the innermost function
+        of the protocol that is not a helper, or the comment label of the
+        current line when called directly from `run`.
+        """
+        frame = inspect.currentframe()
+        while frame:
+            code = frame.f_code
+            if os.path.abspath(code.co_filename) == self.path:
+                name = code.co_name
+                if name == 'run':
+                    return self.labels.get(frame.f_lineno, 'setup')
+                if name not in HELPER_FUNCTIONS and \
+                        not name.startswith(('_', '<')):
+                    return name
+            frame = frame.f_back
+        return 'setup'
+
+    def clock(self):
+        """ Return the estimated seconds since the start of the run. """
+        return self._clock
+
+    def _travel(self, location, speed=None):
+        point = _point(location)
+        if point is None or point == self._position:
+            return 0
+        labware = _labware(location)
+        if self._position is None:
+            self._position, self._labware = point, labware
+            return 0
+        same_labware = labware is not None and labware is self._labware
+        # moves within a well are direct, the location's labware is the well
+        direct = labware is self._labware and not hasattr(labware, 'wells')
+        seconds = travel_time(self.timing, self._position, point,
+                              same_labware, direct, speed)
+        self._position, self._labware = point, labware
+        return seconds
+
+    def _plunger(self, instrument, volume, rate, action):
+        flow_rate = getattr(instrument.flow_rate, action) * (rate or 1.0)
+        return volume/flow_rate + self.timing['plunger_overhead']
+
+    def _price(self, kind, payload):
+        """ Return (travel, action) seconds for a single command. """
+        location = payload.get('location')
+        instrument = payload.get('instrument')
+        # the pipette moves at its default speed when the command starts
+        speed = getattr(instrument, 'default_speed', None)
+        t = self.timing
+        if kind in ['ASPIRATE', 'DISPENSE']:
+            action = 'aspirate' if kind == 'ASPIRATE' else 'dispense'
+            return (self._travel(location, speed), self._plunger(
+                instrument, payload['volume'], payload.get('rate'), action))
+        if kind == 'PICK_UP_TIP':
+            return self._travel(location, speed), t['pick_up_tip']
+        if kind in ['DROP_TIP', 'RETURN_TIP']:
+            return self._travel(location, speed), t['drop_tip']
+        if kind == 'BLOW_OUT':
+            return self._travel(location, speed), t['blow_out']
+        if kind == 'TOUCH_TIP':
+            return 0, t['touch_tip']
+        if kind == 'DELAY':
+            return 0, payload['seconds'] + payload['minutes']*60
+        if kind == 'HOME':
+            self._position = None
+            return 0, t['home']
+        if kind.startswith('MAGDECK'):
+            return 0, t['magdeck']
+        if kind == 'TEMPDECK_SET_TEMP':
+            ramp = abs(self._temperature - payload['celsius'])/t['temp_ramp']
+            self._temperature = payload['celsius']
+            if _started_without_waiting():
+                self._temperature_reached = self._clock + ramp
+                return 0, 0
+            return 0, ramp
+        if kind == 'TEMPDECK_AWAIT_TEMP':
+            return 0, max(self._temperature_reached - self._clock, 0)
+        return 0, 0
+
+    def on_command(self, message):
+        kind = message['name'].split('.')[-1]
+        if message['$'] == 'after':
+            if self._stack:
+                self._stack.pop()
+            return
+        payload = message['payload']
+        parent = self._stack[-1] if self._stack else None
+        record = {
+            'command': kind,
+            'step': self.step(),
+            'depth': len(self._stack),
+            'parent': parent['command'] if parent else None,
+            'instrument': None,
+            'volume': payload.get('volume'),
+            'travel': 0,
+            'action': 0,
+            'operator': kind == 'PAUSE'
+        }
+        instrument = payload.get('instrument')
+        if instrument is not None:
+            record['instrument'] = instrument.name
+            record['channels'] = getattr(instrument, 'channels', 1)
+        if kind not in CONTAINER_COMMANDS:
+            record['travel'], record['action'] = self._price(kind, payload)
+            self._clock += record['travel'] + record['action']
+        if kind == 'PICK_UP_TIP':
+            # tips parked in a tiprack and picked up again are not new
+            well = str(_well(payload['location']))
+            record['fresh'] = well not in self._parked
+            self._parked.discard(well)
+        elif kind == 'DROP_TIP':
+            # tips dropped in a tiprack are parked, not trashed
+            well = _well(payload['location'])
+            record['parked'] = getattr(
+                getattr(well, 'parent', None), 'is_tiprack', False)
+            if record['parked']:
+                self._parked.add(str(well))
+        self.records.append(record)
+        self._stack.append(record)
+
+
+def simulate(path, params=None, timing=None):
+    """
+    `simulate` runs a protocol in the Opentrons simulator and returns the
+    priced command records.
+    :param path (str): Path to the protocol file.
+    :param params (dict): Module-level parameters to override.
+    :param timing (dict): Entries of the timing model to override.
+    """
+    from opentrons import simulate as ot_simulate
+
+    protocol = load_protocol(path, params)
+    ctx = ot_simulate.get_protocol_api(protocol.metadata['apiLevel'])
+    recorder = RunRecorder(path, timing)
+    protocol.time = recorder.clock
+    unsubscribe = ctx.broker.subscribe('command', recorder.on_command)
+    try:
+        protocol.run(ctx)
+    finally:
+        unsubscribe()
+    return recorder.records
+
+
+def summarize(records):
+    """
+    `summarize` aggregates priced records per protocol step, in the order in
+    which the steps first occur.
+    :param records (List[dict]): Records returned by `simulate`.
+    """
+    steps = OrderedDict()
+    for record in records:
+        step = steps.setdefault(record['step'], {
+            'seconds': 0, 'travel': 0, 'pipetting': 0, 'delay': 0,
+            'modules': 0, 'tips': 0, 'pauses': 0})
+        seconds = record['travel'] + record['action']
+        step['seconds'] += seconds
+        step['travel'] += record['travel']
+        if record['command'] == 'DELAY':
+            step['delay'] += record['action']
+        elif record['command'].startswith(('MAGDECK', 'TEMPDECK', 'HOME')):
+            step['modules'] += record['action']
+        elif record['command'] in ['PICK_UP_TIP', 'DROP_TIP', 'RETURN_TIP']:
+            step['tips'] += record['action']
+        else:
+            step['pipetting'] += record['action']
+        if record['operator']:
+            step['pauses'] += 1
+    total = {
+        'seconds': sum(step['seconds'] for step in steps.values()),
+        'pauses': sum(step['pauses'] for step in steps.values())
+    }
+    return {'steps': steps, 'total': total}
+
+
+def _format_time(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def print_summary(summary, out=sys.stdout):
+    columns = ['travel', 'pipetting', 'tips', 'delay', 'modules']
+    out.write('{:<48}{:>10}'.format('step', 'total'))
+    for column in columns:
+        out.write('{:>11}'.format(column))
+    out.write('{:>8}\n'.format('pauses'))
+    for name, step in summary['steps'].items():
+        out.write('{:<48}{:>10}'.format(name[:47],
+                                        _format_time(step['seconds'])))
+        for column in columns:
+            out.write('{:>11}'.format(_format_time(step[column])))
+        out.write('{:>8}\n'.format(step['pauses']))
+    out.write('\nestimated robot time: ' + _format_time(
+        summary['total']['seconds']))
+    if summary['total']['pauses']:
+        out.write(' (+ operator time for ' + str(
+            summary['total']['pauses']) + ' pauses)')
+    out.write('\n')
+
+
+def parse_params(assignments):
+    params = {}
+    for assignment in assignments or []:
+        name, _, value = assignment.partition('=')
+        params[name.strip()] = parse_value(value.strip())
+    return params
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Estimate the walltime of a station protocol.')
+    parser.add_argument('protocol', help='path to the protocol file')
+    parser.add_argument('--set', action='append', metavar='NAME=VALUE',
+                        help='override a module-level protocol parameter')
+    parser.add_argument('--timing', action='append', metavar='NAME=VALUE',
+                        help='override an entry of the timing model')
+    parser.add_argument('--json', action='store_true',
+                        help='print the per-step breakdown as JSON')
+    args = parser.parse_args(argv)
+
+    records = simulate(args.protocol, parse_params(args.set),
+                       parse_params(args.timing))
+    summary = summarize(records)
+    if args.json:
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Check the consumables of a station protocol before it is run on a robot.
+
+The protocol is executed against the Opentrons simulator with the parameters
+it will be run with. The tips picked up per tiprack type, the tips dropped in
+the trash and the liquid dispensed into the liquid waste containers are
+compared with the tipracks loaded for the pipettes, the trash capacity the
+protocol announces and its `waste_threshold` per container. Every `ctx.pause`
+the run would make to refill tipracks or to empty the trash or the liquid
+waste is reported with the step it happens in, together with extra racks and
+free deck slots that avoid the refills.
+
+The check fails (exit status 1) when the run would pause for consumables or
+would overflow the trash or the liquid waste, unless --warn is given.
+
+Usage:
+    python tools/preflight.py "Station B/Thermo Fisher/\
+v1_s9_station_b_thermo.py" --set num_samples=96
+"""
+import argparse
+import ast
+import math
+import sys
+from collections import OrderedDict
+
+from estimate_runtime import RunRecorder, _well, load_protocol, parse_params
+
+DECK_SLOTS = [str(slot) for slot in range(1, 12)]
+TIPS_PER_RACK = 96
+
+# label of the liquid waste labware
+WASTE_LABEL = 'Liquid Waste'
+
+# comment in which a protocol announces how many tips its trash holds
+TRASH_CAPACITY = 'The trash holds about '
+
+# phrases of the operator pauses that are caused by consumables
+CONSUMABLE_PAUSES = OrderedDict([
+    ('tips', 'tipracks before resuming'),
+    ('trash', 'empty tips from waste'),
+    ('liquid waste', 'empty liquid waste')
+])
+
+
+def read_limits(path):
+    """
+    `read_limits` returns the `waste_threshold` assigned in a protocol, if
+    any.
+    :param path (str): Path to the protocol file.
+    """
+    limits = {}
+    with open(path, encoding='utf-8') as protocol_file:
+        tree = ast.parse(protocol_file.read())
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Assign):
+            continue
+        names = [target.id for target in node.targets
+                 if isinstance(target, ast.Name)]
+        if 'waste_threshold' in names:
+            limits['waste_threshold'] = ast.literal_eval(node.value)
+    return limits
+
+
+class ConsumablesRecorder(RunRecorder):
+    """
+    `ConsumablesRecorder` counts the tips, trash and liquid waste a protocol
+    uses and the operator pauses they cause.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.tips = OrderedDict()
+        self.racks = OrderedDict()
+        self.trash = 0
+        self.trash_capacity = None
+        self.waste = 0
+        self.wastes = set()
+        self._air = {}
+        self.pauses = []
+
+    def on_command(self, message):
+        super().on_command(message)
+        if message['$'] == 'after':
+            return
+        kind = message['name'].split('.')[-1]
+        payload = message['payload']
+        instrument = payload.get('instrument')
+        channels = getattr(instrument, 'channels', 1)
+        if instrument is not None:
+            # pipettes replaced mid-run keep their racks in the count
+            for rack in instrument.tip_racks:
+                self.racks[id(rack)] = rack
+        if kind == 'PICK_UP_TIP':
+            # the run recorder knows which tips were parked and are not new
+            if self.records[-1]['fresh']:
+                name = _well(payload['location']).parent.load_name
+                self.tips[name] = self.tips.get(name, 0) + channels
+        elif kind == 'DROP_TIP':
+            if not self.records[-1]['parked']:
+                self.trash += channels
+        elif kind == 'ASPIRATE' and self.records[-1]['parent'] == 'AIR_GAP':
+            self._air[instrument] = self._air.get(instrument, 0) + \
+                payload['volume']
+        elif kind == 'DISPENSE':
+            # an air gap sits at the end of the tip and is dispensed first
+            air = self._air.get(instrument, 0)
+            liquid = max(payload['volume'] - air, 0)
+            self._air[instrument] = max(air - payload['volume'], 0)
+            labware = getattr(_well(payload['location']), 'parent', None)
+            if getattr(labware, 'name', None) == WASTE_LABEL:
+                self.waste += liquid*channels
+                self.wastes.add(labware.parent)
+        elif kind == 'COMMENT' and \
+                payload['text'].startswith(TRASH_CAPACITY):
+            self.trash_capacity = int(
+                payload['text'][len(TRASH_CAPACITY):].split()[0])
+        elif kind == 'PAUSE':
+            text = (payload.get('userMessage') or '').lower()
+            for consumable, phrase in CONSUMABLE_PAUSES.items():
+                if phrase in text:
+                    self.pauses.append((consumable, self.records[-1]['step']))
+
+
+def check(path, params=None):
+    """
+    `check` simulates a protocol and returns its consumables report.
+    :param path (str): Path to the protocol file.
+    :param params (dict): Module-level parameters to override.
+    """
+    from opentrons import simulate as ot_simulate
+
+    limits = read_limits(path)
+    protocol = load_protocol(path, params)
+    ctx = ot_simulate.get_protocol_api(protocol.metadata['apiLevel'])
+    recorder = ConsumablesRecorder(path)
+    unsubscribe = ctx.broker.subscribe('command', recorder.on_command)
+    try:
+        protocol.run(ctx)
+    finally:
+        unsubscribe()
+
+    free_slots = [slot for slot in DECK_SLOTS if ctx.deck[slot] is None]
+    tips = OrderedDict()
+    for name, needed in recorder.tips.items():
+        loaded = [rack for rack in recorder.racks.values()
+                  if rack.load_name == name]
+        racks_needed = math.ceil(needed/TIPS_PER_RACK)
+        tips[name] = {
+            'needed': needed,
+            'loaded': len(loaded)*TIPS_PER_RACK,
+            'slots': [rack.parent for rack in loaded],
+            'extra_racks': max(racks_needed - len(loaded), 0)
+        }
+    report = OrderedDict([
+        ('tips', tips),
+        ('trash', {'dropped': recorder.trash,
+                   'threshold': recorder.trash_capacity}),
+        ('liquid waste', {
+            'volume': round(recorder.waste, 1),
+            'threshold': limits.get('waste_threshold', 0)*len(
+                recorder.wastes)}),
+        ('pauses', recorder.pauses),
+        ('free slots', free_slots)
+    ])
+    report['warnings'] = overflows(report)
+    report['suggestions'] = suggest(report)
+    return report
+
+
+def overflows(report):
+    """
+    `overflows` returns a warning for the trash and the liquid waste when
+    the protocol pauses fewer times to empty them than their threshold needs.
+    """
+    warnings = []
+    for consumable, key, unit in [('trash', 'dropped', ' tips'),
+                                  ('liquid waste', 'volume', ' µl')]:
+        used = report[consumable][key]
+        threshold = report[consumable]['threshold']
+        if not threshold or not used:
+            continue
+        needed = math.ceil(used/threshold) - 1
+        paused = sum(1 for pause in report['pauses']
+                     if pause[0] == consumable)
+        if paused < needed:
+            warnings.append(
+                'the ' + consumable + ' takes ' + str(round(used)) + unit +
+                ' but is emptied ' + str(paused) + ' of the ' + str(needed) +
+                ' times needed, it will overflow')
+    return warnings
+
+
+def suggest(report):
+    """
+    `suggest` returns the deck changes that let the run finish without
+    pausing for consumables, or says which pauses cannot be avoided.
+    """
+    suggestions = []
+    free_slots = list(report['free slots'])
+    for name, tips in report['tips'].items():
+        extra = tips['extra_racks']
+        if not extra:
+            continue
+        slots, free_slots = free_slots[:extra], free_slots[extra:]
+        if slots:
+            suggestions.append(
+                'load ' + str(len(slots)) + ' more ' + name + ' in slot' +
+                ('s ' if len(slots) > 1 else ' ') + ', '.join(slots) +
+                ' and add ' + ('them' if len(slots) > 1 else 'it') +
+                ' to the tip_racks of the pipette')
+        if len(slots) < extra:
+            suggestions.append(
+                'no free slot for ' + str(extra - len(slots)) + ' more ' +
+                name + ', have ' + str(extra - len(slots)) +
+                ' full racks ready for the refill pauses')
+    for consumable in ['trash', 'liquid waste']:
+        count = sum(1 for pause in report['pauses']
+                    if pause[0] == consumable)
+        if count:
+            suggestions.append(
+                'empty the ' + consumable + ' ' + str(count) +
+                (' times' if count > 1 else ' time') +
+                ' during the run, starting with it empty')
+    return suggestions
+
+
+def print_report(report, out=sys.stdout):
+    for name, tips in report['tips'].items():
+        out.write('{:<40}{:>6} tips needed, {:>4} loaded in slots {}\n'.format(
+            name, tips['needed'], tips['loaded'],
+            ', '.join(tips['slots']) or '-'))
+    trash = report['trash']
+    out.write('{:<40}{:>6} tips dropped'.format('trash', trash['dropped']))
+    if trash['threshold']:
+        out.write(', emptied every ' + str(trash['threshold']))
+    out.write('\n')
+    waste = report['liquid waste']
+    if waste['volume']:
+        out.write('{:<40}{:>6} µl'.format('liquid waste', round(
+            waste['volume'])))
+        if waste['threshold']:
+            out.write(', emptied every ' + str(waste['threshold']) + ' µl')
+        out.write('\n')
+    out.write('free slots: ' + (', '.join(report['free slots']) or '-') +
+              '\n')
+    for warning in report['warnings']:
+        out.write('\nWARNING: ' + warning + '\n')
+    if not report['pauses']:
+        if not report['warnings']:
+            out.write('\nOK: the run finishes without pausing for '
+                      'consumables\n')
+        return
+    out.write('\n' + str(len(report['pauses'])) +
+              ' pauses for consumables:\n')
+    for consumable, step in report['pauses']:
+        out.write('  ' + consumable + ' in ' + step + '\n')
+    out.write('\nplan:\n')
+    for suggestion in report['suggestions']:
+        out.write('  ' + suggestion + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check the consumables of a station protocol.')
+    parser.add_argument('protocol', help='path to the protocol file')
+    parser.add_argument('--set', action='append', metavar='NAME=VALUE',
+                        help='override a module-level protocol parameter')
+    parser.add_argument('--warn', action='store_true',
+                        help='only warn about pauses for consumables')
+    args = parser.parse_args(argv)
+
+    report = check(args.protocol, parse_params(args.set))
+    print_report(report)
+    failed = report['pauses'] or report['warnings']
+    return 1 if failed and not args.warn else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())